@@ -1,102 +1,98 @@
 import asyncio
-from collections import deque
 from loguru import logger
-from pymavlink import mavutil
 
 from ping.PingManager import PingManager
 from mavlink.DataManager import DataManager
+from mavlink.MavlinkReceiver import start_mavlink_receiver
+from mavlink.MavlinkStream import MavlinkStream
+from mavlink.SensorBuffer import SensorBuffer
 
+from settings import MAVLINK_HOST, MAVLINK_PORT, MAVLINK_WS_BACKOFF, TELEMETRY_SOURCE
 from typedefs import MavlinkMessage
 
 
-class SensorBuffer:
-    def __init__(self, max_size, type):
-        self.buffer = deque(maxlen=max_size)
-        self.lock = asyncio.Lock()
-        self.type = type
-
-    async def add_data(self, data):
-        async with self.lock:
-            self.buffer.append(data)
-            # logger.debug(f"Updated {self.type} buffer.")
-
-    async def get_latest_data(self):
-        async with self.lock:
-            return self.buffer[-1] if self.buffer else None
-
-    async def get_data_near_timestamp(self, target_time):
-        """Return the closest data to the target timestamp."""
-        async with self.lock:
-            closest_data = None
-            min_time_diff = float('inf')
-
-            for data in self.buffer:
-                timestamp = data['timestamp']
-                time_diff = abs(target_time - timestamp)
-                if time_diff < min_time_diff:
-                    min_time_diff = time_diff
-                    closest_data = (timestamp, data)
-
-            return closest_data
-
-
 class Processor:
 
     def __init__(self):
         self.data_manager = DataManager()
-
-        self.mav = mavutil.mavlink_connection('udpin:0.0.0.0:14555')
-        logger.info("Mavlink connection established.")
-
-        self.imu_buffer = SensorBuffer(10, MavlinkMessage.RAW_IMU)
-        self.attitude_buffer = SensorBuffer(10, MavlinkMessage.ATTITUDE)
-        self.gps_buffer = SensorBuffer(10, MavlinkMessage.GLOBAL_POSITION_INT)
-        self.pressure_buffer = SensorBuffer(10, MavlinkMessage.SCALED_PRESSURE)
-        self.servo_buffer = SensorBuffer(10, MavlinkMessage.SERVO_OUTPUT_RAW)
+        self.receiver = None
+
+        self.imu_buffer = SensorBuffer(MavlinkMessage.RAW_IMU)
+        self.attitude_buffer = SensorBuffer(MavlinkMessage.ATTITUDE)
+        self.gps_buffer = SensorBuffer(MavlinkMessage.GLOBAL_POSITION_INT)
+        self.pressure_buffer = SensorBuffer(MavlinkMessage.SCALED_PRESSURE)
+        self.servo_buffer = SensorBuffer(MavlinkMessage.SERVO_OUTPUT_RAW)
+        self.buffers = {buffer.type.value: buffer for buffer in (
+            self.imu_buffer, self.attitude_buffer, self.gps_buffer, self.pressure_buffer, self.servo_buffer)}
+        self.stream = MavlinkStream(self.buffers.values())
+
+    async def write_rest_buffer(self, buffer):
+        """Poll one message type from mavlink2rest, backing off like the WebSocket stream while it fails."""
+        min_delay, max_delay = MAVLINK_WS_BACKOFF
+        delay = min_delay
+        while True:
+            data = await self.data_manager.get_message(buffer.type)
+            if data is not None:
+                buffer.add_data(data)
+                delay = min_delay
+                await asyncio.sleep(0)
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+    async def write_rest_buffers(self):
+        """
+        Poll every buffered message type from mavlink2rest concurrently over the pooled connections.
+
+        Each type is polled by its own loop, so one that times out does not hold back the others.
+        """
+        await asyncio.gather(*(self.write_rest_buffer(buffer) for buffer in self.buffers.values()))
 
     async def write_gps_buffer_rest(self):
-        while True:
-            data = await self.data_manager.get_gps_data()
-            await self.gps_buffer.add_data(data)
-            # print(f"Added gps data: {data}")
-            await asyncio.sleep(0)
+        await self.write_rest_buffer(self.gps_buffer)
 
     async def write_imu_buffer_rest(self):
-        while True:
-            data = await self.data_manager.get_imu_data()
-            await self.imu_buffer.add_data(data)
-            # print(f"Added imu data: {data}")
-            await asyncio.sleep(0)
+        await self.write_rest_buffer(self.imu_buffer)
 
     async def write_attitude_buffer_rest(self):
-        while True:
-            data = await self.data_manager.get_attitude_data()
-            await self.attitude_buffer.add_data(data)
-            # print(f"Added attitude data: {data}")
-            await asyncio.sleep(0)
+        await self.write_rest_buffer(self.attitude_buffer)
 
     async def write_pressure_buffer_rest(self):
-        while True:
-            data = await self.data_manager.get_pressure_data()
-            await self.pressure_buffer.add_data(data)
-            # print(f"Added pressure data: {data}")
-            await asyncio.sleep(0)
+        await self.write_rest_buffer(self.pressure_buffer)
 
     async def receive_mavlink_data(self):
-        while True:
-            msg = self.mav.recv_match()
-            if msg:
-                await self.write_sensor_buffer(msg.get_type(), msg.to_dict())
-            await asyncio.sleep(0)
-
-    async def write_sensor_buffer(self, msg_type, msg):
-        if msg_type == MavlinkMessage.RAW_IMU:
-            await self.imu_buffer.add_data(msg)
-        elif msg_type == MavlinkMessage.ATTITUDE:
-            await self.attitude_buffer.add_data(msg)
-        elif msg_type == MavlinkMessage.GLOBAL_POSITION_INT:
-            await self.gps_buffer.add_data(msg)
-        elif msg_type == MavlinkMessage.SCALED_PRESSURE:
-            await self.pressure_buffer.add_data(msg)
-        elif msg_type == MavlinkMessage.SERVO_OUTPUT_RAW:
-            await self.servo_buffer.add_data(msg)
+        """Receive MAVLink over UDP into the sensor buffers until cancelled."""
+        transport, self.receiver = await start_mavlink_receiver(self.buffers.values(), MAVLINK_HOST, MAVLINK_PORT)
+        logger.info(f"Receiving MAVLink on udp {MAVLINK_HOST}:{MAVLINK_PORT}.")
+        try:
+            await asyncio.Future()
+        finally:
+            transport.close()
+
+    async def stream_mavlink_data(self):
+        """Receive the mavlink2rest WebSocket stream into the sensor buffers until cancelled."""
+        await self.stream.run()
+
+    async def run_telemetry(self, source=TELEMETRY_SOURCE):
+        """Fill the sensor buffers from MAVLink over "udp", the mavlink2rest "websocket" or "rest" polling."""
+        sources = {
+            "udp": self.receive_mavlink_data,
+            "websocket": self.stream_mavlink_data,
+            "rest": self.write_rest_buffers,
+        }
+        if source not in sources:
+            raise ValueError(f"Unknown telemetry source {source}, available: {list(sources)}")
+        await sources[source]()
+
+    def write_sensor_buffer(self, msg):
+        """Store a decoded pymavlink message in the buffer of its type, if there is one."""
+        buffer = self.buffers.get(msg.get_type())
+        if buffer is not None:
+            buffer.append_message(msg)
+
+    def get_mavlink_stats(self):
+        stats = self.receiver.get_stats() if self.receiver is not None else {}
+        stats["stream"] = self.stream.get_stats()
+        stats["buffered"] = {buffer.type.value: {"messages": len(buffer), "seconds": round(buffer.duration, 3)}
+                             for buffer in self.buffers.values()}
+        return stats
@@ -8,7 +8,7 @@ import h5py
 import sys
 import numpy as np
 from loguru import logger
-from typing import Any
+from typing import Any, Dict, List
 
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
@@ -16,8 +16,10 @@ from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi_versioning import VersionedFastAPI, version
 from Processor import Processor
 from pydantic import BaseModel
+from ping.CFAR import warm_up_threshold_factors
 from ping.PingManager import PingManager
 from ping.ScanRecorder import SonarRecorder
+from ping.ThresholdCache import threshold_cache
 from uvicorn import Config, Server
 
 from settings import *
@@ -30,6 +32,11 @@ class CFARParams(BaseModel):
     threshold: int
 
 
+class PipelineConfig(BaseModel):
+    stages: List[str]
+    params: Dict[str, Dict[str, Any]] = {}
+
+
 SERVICE_NAME = "slam"
 
 app = FastAPI(
@@ -43,6 +50,8 @@ data_processor = Processor()
 ping_manager = PingManager(
     device=None, baudrate=115200, udp=UDP_PORT, live=LIVE_SONAR)
 scan_recorder = SonarRecorder()
+# Serializes starting and stopping, a start waits until the previous recording is closed
+recording_lock = None
 
 logger.info("Register sonar callback")
 ping_manager.register_scan_update_callback(scan_recorder.save_scan)
@@ -88,17 +97,55 @@ async def update_cfar_params(params: CFARParams):
         return {"detail": f"Error updating parameters: {str(e)}"}
 
 
+@app.get("/pipeline")
+@version(1, 0)
+async def get_pipeline():
+    pipeline = ping_manager.feature_extractor.pipeline
+    return {**pipeline.get_config(), "stats": pipeline.get_stats()}
+
+
+@app.post("/pipeline")
+@version(1, 0)
+async def configure_pipeline(config: PipelineConfig):
+    try:
+        ping_manager.feature_extractor.pipeline.configure(config.stages, config.params)
+    except (ValueError, TypeError) as e:
+        return {"detail": f"Invalid pipeline: {str(e)}"}
+
+    return {"status": "success", **ping_manager.feature_extractor.pipeline.get_config()}
+
+
 @app.post("/record_ping")
 @version(1, 0)
 async def toggle_scan_recording():
-    if scan_recorder.file is None:
-        scan_recorder.start_recording()
-    else:
-        scan_recorder.stop_recording()
+    async with recording_lock:
+        if not scan_recorder.is_recording:
+            scan_recorder.start_recording()
+        else:
+            # Waits for the writer thread to drain its queue
+            await asyncio.to_thread(scan_recorder.stop_recording)
 
     return {"status": "success"}
 
 
+@app.get("/record_ping")
+@version(1, 0)
+async def get_scan_recording_status():
+    return scan_recorder.get_stats()
+
+
+@app.get("/scan_stats")
+@version(1, 0)
+async def get_scan_stats():
+    return ping_manager.get_scan_stats()
+
+
+@app.get("/mavlink_stats")
+@version(1, 0)
+async def get_mavlink_stats():
+    return data_processor.get_mavlink_stats()
+
+
 @app.get("/costmap")
 @version(1, 0)
 async def get_costmap():
@@ -128,6 +175,33 @@ async def get_costmap():
     return StreamingResponse(buf, media_type="image/png")
 
 
+@app.get("/cartesian_scan")
+@version(1, 0)
+async def get_cartesian_scan():
+    image, x, y = await ping_manager.get_cartesian_scan()
+
+    if image is None or image.size == 0:
+        logger.warning("No scan data available.")
+        return {"message": "No scan data available yet."}
+
+    plt.figure(figsize=(8, 8))
+    plt.pcolormesh(x, y, image)
+    plt.title('Sonar Scan - Cartesian View')
+    plt.xlabel('X Coordinate (m)')
+    plt.ylabel('Y Coordinate (m)')
+    plt.axis('equal')
+    plt.grid(True)
+
+    # Save plot to a BytesIO object
+    buf = io.BytesIO()
+    plt.savefig(buf, format='png')
+    buf.seek(0)
+    plt.close()
+
+    # Serve the image as a streaming response
+    return StreamingResponse(buf, media_type="image/png")
+
+
 @app.get("/sonar_scan")
 @version(1, 0)
 async def get_scan_data():
@@ -142,7 +216,7 @@ async def get_scan_data():
     azimuths = np.array(angles)
 
     # Range resolution calculation
-    resolution = (WATER_SOS * SAMPLE_PERIOD * 25e-9) / 2
+    resolution = ping_manager.get_scan_resolution()
     num_ranges = scan_data.shape[0]
     num_azimuths = scan_data.shape[1]
 
@@ -205,7 +279,7 @@ async def get_cfar_data():
     azimuths = np.array(angles)
 
     # Range resolution calculation
-    resolution = (WATER_SOS * SAMPLE_PERIOD * 25e-9) / 2
+    resolution = ping_manager.get_scan_resolution()
     num_ranges = scan_data.shape[0]
     num_azimuths = scan_data.shape[1]  # Make sure to get the correct dimension
 
@@ -273,7 +347,7 @@ async def get_polar_scan_data():
     azimuths = np.array(angles)
 
     # Range resolution calculation
-    resolution = (WATER_SOS * SAMPLE_PERIOD * 25e-9) / 2
+    resolution = ping_manager.get_scan_resolution()
     num_ranges = scan_data.shape[0]
     num_azimuths = scan_data.shape[1]
 
@@ -371,18 +445,28 @@ async def root() -> HTMLResponse:
     return HTMLResponse(content="index.html", status_code=200)
 
 
+async def warm_up_cfar():
+    threshold_cache.load()
+    count = await asyncio.to_thread(warm_up_threshold_factors, CFAR_WARMUP_GRID)
+    await asyncio.to_thread(threshold_cache.save)
+    logger.info(f"CFAR threshold factors warmed up: {count}")
+
+
 async def start_services():
+    global recording_lock
+    recording_lock = asyncio.Lock()
+
     logger.info("Starting data processor.")
-    # asyncio.create_task(data_processor.receive_mavlink_data())
+    if CFAR_WARMUP:
+        asyncio.create_task(warm_up_cfar())
+    else:
+        threshold_cache.load()
+    if TELEMETRY_SOURCE:
+        asyncio.create_task(data_processor.run_telemetry())
     if LIVE_SONAR:
-        asyncio.create_task(ping_manager.get_ping_data(
-            transmit_duration=TRANSMIT_DURATION,
-            sample_period=SAMPLE_PERIOD,
-            transmit_frequency=TRANSMIT_FREQUENCY
-        ))
+        asyncio.create_task(ping_manager.sonar_scanning())
     else:
-        asyncio.create_task(ping_manager.read_recording(
-            "/app/sonar_data/sonar_better.h5"))
+        asyncio.create_task(ping_manager.read_recording(REPLAY_FILE))
 
     # Running the uvicorn server in the background
     config = Config(app=app, host="0.0.0.0", port=9050, log_config=None)
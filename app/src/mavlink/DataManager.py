@@ -1,12 +1,12 @@
+import aiohttp
 import asyncio
 import csv
 import os
-import requests
 from datetime import datetime
 from loguru import logger
 
 from typedefs import AttitudeData, GPSData, IMUData, PressureData, TimeData, LocalizationData, MavlinkMessage
-from settings import DATA_FILEPATH, VEHICLE_IP
+from settings import DATA_FILEPATH, VEHICLE_IP, REST_CONNECTIONS, REST_KEEPALIVE, REST_TIMEOUT
 
 
 class DataManager:
@@ -15,6 +15,8 @@ class DataManager:
         self.recorded_data = {}
         self.is_recording = False
         self.recording_task = None
+        self.session = None
+        self.timeout = aiohttp.ClientTimeout(total=REST_TIMEOUT)
 
     async def start_recording(self):
         if self.is_recording:
@@ -54,108 +56,105 @@ class DataManager:
         else:
             logger.warning(f"File path {DATA_FILEPATH} does not exist.")
 
-    async def get_gps_data(self):
-        path = os.path.join(self.url, MavlinkMessage.GLOBAL_POSITION_INT)
+    async def get_session(self):
+        """Shared HTTP session, its connection pool keeps the connections to mavlink2rest open."""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=REST_CONNECTIONS, keepalive_timeout=REST_KEEPALIVE)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def fetch(self, path):
+        """GET a mavlink2rest path as JSON, None when it failed or took longer than REST_TIMEOUT."""
+        session = await self.get_session()
         try:
-            gps_response = requests.get(path, timeout=1)
-            msg = gps_response.json()['message']
+            async with session.get(path, timeout=self.timeout) as response:
+                response.raise_for_status()
+                return await response.json()
 
-            temp_pos = GPSData(
-                timestamp=msg['time_boot_ms'],
-                altitude=msg['alt'],
-                latitude=msg['lat'],
-                longitude=msg['lon']
-            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.error(
+                f"Could not get {path} response {e!r}.")
 
-            return temp_pos
+    async def get_message(self, message):
+        """Latest message of a type as the mavlink2rest field dict, None when it could not be fetched."""
+        response = await self.fetch(os.path.join(self.url, message))
+        return response['message'] if response else None
 
-        except requests.RequestException as e:
-            logger.error(
-                f"Could not get {MavlinkMessage.GLOBAL_POSITION_INT} response {e}.")
+    async def get_messages(self, messages):
+        """Latest message of each type, fetched concurrently, as {type: field dict or None}."""
+        results = await asyncio.gather(*(self.get_message(message) for message in messages))
+        return dict(zip(messages, results))
+
+    async def get_gps_data(self):
+        msg = await self.get_message(MavlinkMessage.GLOBAL_POSITION_INT)
+        if msg is None:
+            return None
+
+        return GPSData(
+            timestamp=msg['time_boot_ms'],
+            altitude=msg['alt'],
+            latitude=msg['lat'],
+            longitude=msg['lon']
+        )
 
     async def get_imu_data(self):
-        path = os.path.join(self.url, MavlinkMessage.RAW_IMU)
-        try:
-            imu_response = requests.get(path, timeout=1)
-            msg = imu_response.json()['message']
-
-            temp_pos = IMUData(
-                timestamp=msg['time_usec'],
-                x_acc=msg['xacc'],
-                x_gyro=msg['xgyro'],
-                y_acc=msg['yacc'],
-                y_gyro=msg['ygyro'],
-                z_acc=msg['zacc'],
-                z_gyro=msg['zgyro']
-            )
-
-            return temp_pos
-
-        except requests.RequestException as e:
-            logger.error(
-                f"Could not get {MavlinkMessage.RAW_IMU} response {e}.")
+        msg = await self.get_message(MavlinkMessage.RAW_IMU)
+        if msg is None:
+            return None
+
+        return IMUData(
+            timestamp=msg['time_usec'],
+            x_acc=msg['xacc'],
+            x_gyro=msg['xgyro'],
+            y_acc=msg['yacc'],
+            y_gyro=msg['ygyro'],
+            z_acc=msg['zacc'],
+            z_gyro=msg['zgyro']
+        )
 
     async def get_attitude_data(self):
-        path = os.path.join(self.url, MavlinkMessage.ATTITUDE)
-        try:
-            att_response = requests.get(path, timeout=1)
-            msg = att_response.json()['message']
-
-            temp_pos = AttitudeData(
-                timestamp=msg['time_boot_ms'],
-                roll=msg['roll'],
-                pitch=msg['pitch'],
-                yaw=msg['yaw'],
-                roll_speed=msg['rollspeed'],
-                pitch_speed=msg['pitchspeed'],
-                yaw_speed=msg['yawspeed']
-            )
-
-            return temp_pos
-
-        except requests.RequestException as e:
-            logger.error(
-                f"Could not get {MavlinkMessage.ATTITUDE} response {e}.")
+        msg = await self.get_message(MavlinkMessage.ATTITUDE)
+        if msg is None:
+            return None
+
+        return AttitudeData(
+            timestamp=msg['time_boot_ms'],
+            roll=msg['roll'],
+            pitch=msg['pitch'],
+            yaw=msg['yaw'],
+            roll_speed=msg['rollspeed'],
+            pitch_speed=msg['pitchspeed'],
+            yaw_speed=msg['yawspeed']
+        )
 
     async def get_pressure_data(self):
-        path = os.path.join(self.url, MavlinkMessage.SCALED_PRESSURE)
-        try:
-            att_response = requests.get(path, timeout=1)
-            msg = att_response.json()['message']
-
-            temp_press = PressureData(
-                timestamp=msg['time_boot_ms'],
-                press_abs=msg['press_abs'],
-                press_diff=msg['press_diff']
-            )
-
-            return temp_press
-
-        except requests.RequestException as e:
-            logger.error(
-                f"Could not get {MavlinkMessage.SCALED_PRESSURE} response {e}.")
+        msg = await self.get_message(MavlinkMessage.SCALED_PRESSURE)
+        if msg is None:
+            return None
+
+        return PressureData(
+            timestamp=msg['time_boot_ms'],
+            press_abs=msg['press_abs'],
+            press_diff=msg['press_diff']
+        )
 
     async def get_time_data(self):
-        path = os.path.join(self.url, MavlinkMessage.SYSTEM_TIME)
-        try:
-            att_response = requests.get(path, timeout=1)
-            msg = att_response.json()['message']
-
-            temp_time = TimeData(
-                timestamp=msg['time_boot_ms']
-            )
-
-            return temp_time
+        msg = await self.get_message(MavlinkMessage.SYSTEM_TIME)
+        if msg is None:
+            return None
 
-        except requests.RequestException as e:
-            logger.error(
-                f"Could not get {MavlinkMessage.SYSTEM_TIME} response {e}.")
+        return TimeData(
+            timestamp=msg['time_boot_ms']
+        )
 
     async def get_localization_data(self):
-        gps = await self.get_gps_data()
-        imu = await self.get_imu_data()
-        att = await self.get_attitude_data()
-        press = await self.get_pressure_data()
+        gps, imu, att, press = await asyncio.gather(
+            self.get_gps_data(), self.get_imu_data(), self.get_attitude_data(), self.get_pressure_data())
 
         loc_data = LocalizationData(
             timestamp=datetime.now(),
@@ -171,10 +170,8 @@ class DataManager:
         logger.info("Recording data is running!")
         try:
             while self.is_recording:
-                gps_data = await self.get_gps_data()
-                imu_data = await self.get_imu_data()
-                attitude_data = await self.get_attitude_data()
-                pressure_data = await self.get_pressure_data()
+                gps_data, imu_data, attitude_data, pressure_data = await asyncio.gather(
+                    self.get_gps_data(), self.get_imu_data(), self.get_attitude_data(), self.get_pressure_data())
 
                 if not self.recorded_data:
                     self.recorded_data['timestamp'] = [datetime.now()]
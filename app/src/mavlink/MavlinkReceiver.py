@@ -0,0 +1,83 @@
+import asyncio
+
+from loguru import logger
+from pymavlink.dialects.v20 import ardupilotmega as mavlink
+
+from mavlink.SensorBuffer import message_id
+
+MAVLINK1_HEADER_LEN = 6
+MAVLINK2_HEADER_LEN = 10
+MAVLINK_CHECKSUM_LEN = 2
+
+
+class MavlinkReceiver(asyncio.DatagramProtocol):
+    """
+    Asyncio UDP protocol writing MAVLink messages into the SensorBuffers subscribed to them.
+
+    Only the header of each packet is read to find its message ID. Packets of messages without a buffer
+    are skipped undecoded, the others are checked and decoded by pymavlink and stored in their buffer.
+    A datagram may carry several packets, MAVLink 1 and 2 alike.
+    """
+
+    def __init__(self, buffers):
+        self.buffers = {message_id(buffer.type): buffer for buffer in buffers}
+        self.parser = mavlink.MAVLink(None)
+        self.transport = None
+        self.stats = {"datagrams": 0, "packets": 0, "decoded": 0, "skipped": 0, "errors": 0}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            logger.warning(f"MAVLink socket closed: {exc}")
+
+    def error_received(self, exc):
+        logger.warning(f"MAVLink socket error: {exc}")
+
+    def datagram_received(self, data, addr):
+        self.stats["datagrams"] += 1
+        offset = 0
+        while offset < len(data):
+            marker = data[offset]
+            if marker == mavlink.PROTOCOL_MARKER_V2 and offset + MAVLINK2_HEADER_LEN <= len(data):
+                size = MAVLINK2_HEADER_LEN + data[offset + 1] + MAVLINK_CHECKSUM_LEN
+                if data[offset + 2] & mavlink.MAVLINK_IFLAG_SIGNED:
+                    size += mavlink.MAVLINK_SIGNATURE_BLOCK_LEN
+                msgid = data[offset + 7] | data[offset + 8] << 8 | data[offset + 9] << 16
+            elif marker == mavlink.PROTOCOL_MARKER_V1 and offset + MAVLINK1_HEADER_LEN <= len(data):
+                size = MAVLINK1_HEADER_LEN + data[offset + 1] + MAVLINK_CHECKSUM_LEN
+                msgid = data[offset + 5]
+            else:
+                self.stats["errors"] += 1
+                return
+
+            packet = data[offset:offset + size]
+            offset += size
+            if len(packet) < size:
+                self.stats["errors"] += 1
+                return
+            self.stats["packets"] += 1
+
+            buffer = self.buffers.get(msgid)
+            if buffer is None:
+                self.stats["skipped"] += 1
+                continue
+
+            try:
+                msg = self.parser.decode(bytearray(packet))
+            except mavlink.MAVError as e:
+                self.stats["errors"] += 1
+                logger.debug(f"Dropped MAVLink message {msgid}: {e}")
+                continue
+            buffer.append_message(msg)
+            self.stats["decoded"] += 1
+
+    def get_stats(self):
+        return dict(self.stats)
+
+
+async def start_mavlink_receiver(buffers, host, port):
+    """Bind a MavlinkReceiver for buffers to host:port, returns (transport, receiver)."""
+    loop = asyncio.get_running_loop()
+    return await loop.create_datagram_endpoint(lambda: MavlinkReceiver(buffers), local_addr=(host, port))
@@ -0,0 +1,95 @@
+import asyncio
+import json
+
+import aiohttp
+from loguru import logger
+
+from settings import MAVLINK_WS_URL, MAVLINK_WS_BACKOFF, MAVLINK_WS_HEARTBEAT
+
+
+class MavlinkStream:
+    """
+    Telemetry from the mavlink2rest WebSocket, written into the SensorBuffers subscribed to it.
+
+    One subscription, filtered to the buffered message types, replaces polling the REST API: each
+    message arrives once, as soon as mavlink2rest has it. Messages of other vehicles or components are
+    ignored. A connection that fails or closes is reopened after a delay that doubles up to the
+    MAVLINK_WS_BACKOFF maximum and starts over once messages flow again.
+    """
+
+    def __init__(self, buffers, url=MAVLINK_WS_URL, system_id=1, component_id=1):
+        self.buffers = {buffer.type.value: buffer for buffer in buffers}
+        self.url = url
+        self.system_id = system_id
+        self.component_id = component_id
+        self.session = None
+        self.connected = False
+        self.stats = {"connections": 0, "received": 0, "stored": 0, "ignored": 0, "errors": 0}
+
+    @property
+    def filter(self):
+        """mavlink2rest filter, a regular expression matching the buffered message names."""
+        return f"^({'|'.join(sorted(self.buffers))})$"
+
+    async def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def handle(self, text):
+        """Store one mavlink2rest WebSocket message, {"header": {...}, "message": {"type": ..., fields}}."""
+        self.stats["received"] += 1
+        try:
+            packet = json.loads(text)
+            header, message = packet["header"], packet["message"]
+            buffer = self.buffers.get(message["type"])
+            if (buffer is None or header.get("system_id") != self.system_id
+                    or header.get("component_id") != self.component_id):
+                self.stats["ignored"] += 1
+                return
+            if buffer.add_data(message):
+                self.stats["stored"] += 1
+
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.stats["errors"] += 1
+            logger.debug(f"Dropped MAVLink WebSocket message: {e!r}")
+
+    async def run(self):
+        """Stay subscribed until cancelled."""
+        min_delay, max_delay = MAVLINK_WS_BACKOFF
+        delay = min_delay
+        try:
+            while True:
+                try:
+                    session = await self.get_session()
+                    async with session.ws_connect(self.url, params={"filter": self.filter},
+                                                  heartbeat=MAVLINK_WS_HEARTBEAT) as ws:
+                        self.connected = True
+                        self.stats["connections"] += 1
+                        logger.info(f"Subscribed to {self.url} for {', '.join(sorted(self.buffers))}.")
+                        async for msg in ws:
+                            if msg.type == aiohttp.WSMsgType.TEXT:
+                                self.handle(msg.data)
+                                delay = min_delay
+                            elif msg.type == aiohttp.WSMsgType.ERROR:
+                                break
+                    logger.warning(f"MAVLink WebSocket {self.url} closed.")
+
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                    logger.warning(f"MAVLink WebSocket {self.url} failed: {e!r}")
+
+                self.connected = False
+                logger.info(f"Reconnecting to {self.url} in {delay:.1f} s.")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+        finally:
+            self.connected = False
+            await self.close()
+
+    def get_stats(self):
+        return {**self.stats, "connected": self.connected}
@@ -0,0 +1,262 @@
+import math
+
+import numpy as np
+from loguru import logger
+from pymavlink.dialects.v20 import ardupilotmega as mavlink
+from scipy.spatial.transform import Rotation
+
+from settings import SENSOR_HISTORY, SENSOR_TIME_RESET
+from typedefs import MAVLINK_FIELDS, MavlinkMessage
+
+# NumPy types of the MAVLink wire types
+MAVLINK_TYPES = {
+    "uint8_t": np.uint8,
+    "int8_t": np.int8,
+    "uint16_t": np.uint16,
+    "int16_t": np.int16,
+    "uint32_t": np.uint32,
+    "int32_t": np.int32,
+    "uint64_t": np.uint64,
+    "int64_t": np.int64,
+    "float": np.float32,
+    "double": np.float64,
+}
+
+# Seconds per unit of the MAVLink timestamp fields
+TIME_SCALES = {
+    "time_boot_ms": 1e-3,
+    "time_usec": 1e-6,
+    "time_unix_usec": 1e-6,
+}
+
+# Fields that wrap around, as (lowest value, period) in field units
+ANGLE_FIELDS = {
+    MavlinkMessage.ATTITUDE: {"roll": (-math.pi, 2 * math.pi), "yaw": (-math.pi, 2 * math.pi)},
+    MavlinkMessage.GLOBAL_POSITION_INT: {"hdg": (0, 36000)},
+}
+
+
+def message_id(message):
+    return getattr(mavlink, f"MAVLINK_MSG_ID_{MavlinkMessage(message).value}")
+
+
+def message_dtype(message):
+    """Structured dtype of the MAVLINK_FIELDS of a message, with the message's own wire types."""
+    message = MavlinkMessage(message)
+    cls = mavlink.mavlink_map[message_id(message)]
+    types = dict(zip(cls.fieldnames, cls.fieldtypes))
+    lengths = dict(zip(cls.fieldnames, cls.array_lengths))
+
+    fields = []
+    for name in MAVLINK_FIELDS[message]:
+        if types[name] == "char":
+            fields.append((name, f"S{max(lengths[name], 1)}"))
+        elif lengths[name]:
+            fields.append((name, MAVLINK_TYPES[types[name]], (lengths[name],)))
+        else:
+            fields.append((name, MAVLINK_TYPES[types[name]]))
+    return np.dtype(fields)
+
+
+class SensorBuffer:
+    """
+    Preallocated, time-indexed ring buffer of one MAVLink message type, holding seconds of history.
+
+    Messages are stored as records of a NumPy structured array holding the message's MAVLINK_FIELDS,
+    so adding one allocates nothing beyond the decoded message itself. Their timestamps, converted to
+    seconds, are kept strictly increasing in a parallel array: repeated and out of order messages are
+    dropped, and a timestamp far behind the latest one (vehicle reboot) starts the buffer over.
+
+    Capacity is seconds * rate messages, rate being the highest rate the message is expected at. Every
+    message is written twice, at its slot and one ring length further, so the buffered messages are always
+    one contiguous run of the arrays and windows are views. The ring is twice the capacity long, so a view
+    stays intact for at least capacity more messages.
+
+    There is a single writer and no lock: a message is stored before the (tail, head) span that publishes
+    it is replaced in one assignment, and readers only use the span they read, so reads from any thread or
+    task never see a half written message.
+
+    Queries take vehicle times in seconds, single or batched, and find their neighbours by binary search.
+    Times outside the buffered span get the first or last sample.
+    """
+
+    def __init__(self, type, seconds=None, rate=None):
+        self.type = MavlinkMessage(type)
+        self.fields = MAVLINK_FIELDS[self.type]
+        self.time_field = self.fields[0]
+        self.time_scale = TIME_SCALES[self.time_field]
+        self.angle_fields = ANGLE_FIELDS.get(self.type, {})
+
+        default_seconds, default_rate = SENSOR_HISTORY[self.type.value]
+        self.seconds = default_seconds if seconds is None else seconds
+        self.rate = default_rate if rate is None else rate
+        self.capacity = max(math.ceil(self.seconds * self.rate), 1)
+        self.size = 2 * self.capacity  # ring length
+
+        self.buffer = np.zeros(2 * self.size, dtype=message_dtype(self.type))
+        self.times = np.zeros(2 * self.size, dtype=np.float64)
+        self.span = (0, 0)  # (tail, head) counts of messages ever stored, the buffer holds [tail, head)
+        self.dropped = 0
+
+    def __len__(self):
+        return self._run()[1]
+
+    def clear(self):
+        tail, head = self.span
+        self.span = (head, head)
+
+    def _run(self):
+        """First index and length of the contiguous run of buffered messages, oldest first."""
+        tail, head = self.span
+        count = min(head - tail, self.capacity)
+        return (head - count) % self.size, count
+
+    @property
+    def latest_time(self):
+        start, count = self._run()
+        return self.times[start + count - 1] if count else None
+
+    @property
+    def duration(self):
+        """Seconds between the oldest and the latest buffered message."""
+        start, count = self._run()
+        return self.times[start + count - 1] - self.times[start] if count else 0.0
+
+    def append(self, values):
+        """Store a tuple of field values in MAVLINK_FIELDS order, returns False when it was dropped."""
+        timestamp = float(values[0]) * self.time_scale
+        tail, head = self.span
+        if head > tail:
+            latest = self.times[(head - 1) % self.size]
+            if timestamp < latest - SENSOR_TIME_RESET:
+                logger.info(f"{self.type.value} time went back from {latest:.3f} s to {timestamp:.3f} s, "
+                            f"clearing buffer.")
+                tail = head
+            elif timestamp <= latest:
+                self.dropped += 1
+                return False
+
+        slot = head % self.size
+        self.buffer[slot] = values
+        self.buffer[slot + self.size] = values
+        self.times[slot] = timestamp
+        self.times[slot + self.size] = timestamp
+        self.span = (tail, head + 1)
+        return True
+
+    def append_message(self, msg):
+        """Store a decoded pymavlink message."""
+        return self.append(tuple(getattr(msg, field) for field in self.fields))
+
+    def add_data(self, data):
+        """Store a message given as a mapping of field names, e.g. a mavlink2rest message."""
+        return self.append(tuple(data[field] for field in self.fields))
+
+    @staticmethod
+    def _read_only(view):
+        view.flags.writeable = False
+        return view
+
+    def _bracket(self, times, start, count):
+        """Indices of the samples either side of each time and the fraction of the way between them."""
+        times = np.asarray(times, dtype=np.float64)
+        if count == 1:
+            first = np.full(times.shape, start, dtype=np.intp)
+            return first, first, np.zeros(times.shape)
+
+        upper = np.clip(np.searchsorted(self.times[start:start + count], times, side='right'), 1, count - 1)
+        lo, hi = start + upper - 1, start + upper
+        fraction = np.clip((times - self.times[lo]) / (self.times[hi] - self.times[lo]), 0.0, 1.0)
+        return lo, hi, fraction
+
+    def latest(self):
+        start, count = self._run()
+        return self.buffer[start + count - 1].copy() if count else None
+
+    def records(self):
+        """Copy of the buffered records, oldest first."""
+        start, count = self._run()
+        return self.buffer[start:start + count].copy()
+
+    def get_window(self, t0, t1):
+        """
+        Read-only (times, records) views of the messages from t0 to t1 seconds, oldest first.
+
+        The views share the buffer's memory and stay intact for at least capacity more messages,
+        copy them to keep them longer.
+        """
+        start, count = self._run()
+        times = self.times[start:start + count]
+        first = start + int(np.searchsorted(times, t0, side='left'))
+        end = start + int(np.searchsorted(times, t1, side='right'))
+        return self._read_only(self.times[first:end]), self._read_only(self.buffer[first:end])
+
+    def nearest(self, times):
+        """Records closest to each of times, None when the buffer is empty."""
+        start, count = self._run()
+        if not count:
+            return None
+        lo, hi, fraction = self._bracket(times, start, count)
+        return self.buffer[np.where(fraction >= 0.5, hi, lo)]
+
+    def interpolate(self, times, fields=None):
+        """
+        Linear interpolation of fields (default all but the timestamp) at each of times.
+
+        Angle fields (ANGLE_FIELDS) are interpolated the short way round and wrapped back into their
+        range. Where either neighbour is out of that range, e.g. an unknown hdg of UINT16_MAX, the nearest
+        sample is returned as is.
+
+        Returns a float64 array of shape times.shape + (len(fields),), None when the buffer is empty.
+        """
+        start, count = self._run()
+        if not count:
+            return None
+        fields = self.fields[1:] if fields is None else fields
+        lo, hi, fraction = self._bracket(times, start, count)
+        out = np.empty(fraction.shape + (len(fields),))
+        for column, field in enumerate(fields):
+            values = self.buffer[field]
+            first = values[lo].astype(np.float64)
+            last = values[hi].astype(np.float64)
+            if field not in self.angle_fields:
+                out[..., column] = first + fraction * (last - first)
+                continue
+
+            low, period = self.angle_fields[field]
+            step = (last - first + period / 2) % period - period / 2
+            angle = (first + fraction * step - low) % period + low
+            valid = (first >= low) & (first < low + period) & (last >= low) & (last < low + period)
+            out[..., column] = np.where(valid, angle, np.where(fraction >= 0.5, last, first))
+        return out
+
+    def slerp(self, times, fields=("roll", "pitch", "yaw")):
+        """
+        Attitude at each of times by spherical linear interpolation of the (roll, pitch, yaw) fields.
+
+        Returns (roll, pitch, yaw) in radians, shape times.shape + (3,), None when the buffer is empty.
+        """
+        start, count = self._run()
+        if not count:
+            return None
+        lo, hi, fraction = self._bracket(np.ravel(times), start, count)
+        roll, pitch, yaw = fields
+        first = Rotation.from_euler('ZYX', np.column_stack(
+            (self.buffer[yaw][lo], self.buffer[pitch][lo], self.buffer[roll][lo])).astype(np.float64))
+        last = Rotation.from_euler('ZYX', np.column_stack(
+            (self.buffer[yaw][hi], self.buffer[pitch][hi], self.buffer[roll][hi])).astype(np.float64))
+        steps = (first.inv() * last).as_rotvec() * fraction[:, np.newaxis]
+        attitude = (first * Rotation.from_rotvec(steps)).as_euler('ZYX')[:, ::-1]
+        return attitude.reshape(np.shape(times) + (3,))
+
+    def get_latest_data(self):
+        return self.latest()
+
+    def get_data_near_timestamp(self, target_time):
+        """Return (timestamp, record) of the record closest to target_time, in seconds."""
+        start, count = self._run()
+        if not count:
+            return None
+        lo, hi, fraction = self._bracket(target_time, start, count)
+        index = int(hi if fraction >= 0.5 else lo)
+        return self.times[index], self.buffer[index].copy()
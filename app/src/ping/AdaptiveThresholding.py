@@ -0,0 +1,78 @@
+import cv2
+import numpy as np
+
+from settings import ADAPTIVE_WINDOW, ADAPTIVE_K, ADAPTIVE_BAND
+
+
+class AdaptiveThresholding(object):
+    """
+    Local-statistics detectors with the CFAR.detect interface, O(1) per pixel for any window size
+        - Local mean/variance (LOCAL): mean + k * std over a range x beam window, from integral images
+        - Otsu per range band (OTSU): one Otsu threshold per band of range samples
+
+    Thresholds never drop below floor, which keeps empty, all-zero regions from detecting every return.
+    """
+
+    ALGORITHMS = ("LOCAL", "OTSU")
+
+    def __init__(self, window=ADAPTIVE_WINDOW, k=ADAPTIVE_K, band=ADAPTIVE_BAND, floor=0):
+        self.window = (max(int(window[0]), 1), max(int(window[1]), 1))  # range x beam samples
+        self.k = k
+        self.band = max(int(band), 1)
+        self.floor = floor
+
+        self.detector2 = {
+            "LOCAL": self.local_threshold,
+            "OTSU": self.otsu_threshold,
+        }
+
+    def is_range_only(self, alg):
+        """Local statistics mix neighbouring beams, so these detectors need the whole sweep."""
+        return False
+
+    @staticmethod
+    def _window_bounds(n, half):
+        index = np.arange(n)
+        return np.clip(index - half, 0, n), np.clip(index + half + 1, 0, n)
+
+    def local_threshold(self, mat):
+        """Mean + k * std over the window around every cell, windows are clipped at the image border."""
+        img = np.ascontiguousarray(mat, dtype=np.float64)
+        sums, squares = cv2.integral2(img, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+        r0, r1 = self._window_bounds(img.shape[0], self.window[0] // 2)
+        c0, c1 = self._window_bounds(img.shape[1], self.window[1] // 2)
+        count = (r1 - r0)[:, np.newaxis] * (c1 - c0)[np.newaxis, :]
+
+        def box(table):
+            return table[r1][:, c1] - table[r0][:, c1] - table[r1][:, c0] + table[r0][:, c0]
+
+        mean = box(sums) / count
+        variance = np.maximum(box(squares) / count - mean**2, 0.0)
+        threshold = np.maximum(mean + self.k * np.sqrt(variance), self.floor).astype(np.float32)
+        return (mat > threshold).astype(np.uint8), threshold
+
+    def otsu_threshold(self, mat):
+        """Otsu's threshold per band of range samples, computed from each band's 256 bin histogram."""
+        img = np.ascontiguousarray(mat)
+        if img.dtype != np.uint8:
+            img = np.clip(img, 0, 255).astype(np.uint8)
+
+        threshold = np.empty(img.shape, dtype=np.float32)
+        for start in range(0, img.shape[0], self.band):
+            band = img[start:start + self.band]
+            value, _ = cv2.threshold(band, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            threshold[start:start + self.band] = max(value, self.floor)
+        return (mat > threshold).astype(np.uint8), threshold
+
+    def detect(self, mat, alg="LOCAL"):
+        """
+        Return target mask array.
+        """
+        return self.detector2[alg](mat)[0]
+
+    def detect2(self, mat, alg="LOCAL"):
+        """
+        Return target mask array and threshold array.
+        """
+        return self.detector2[alg](mat)
@@ -0,0 +1,65 @@
+from collections import deque
+import math
+
+import numpy as np
+from loguru import logger
+
+from settings import (WATER_SOS, SAMPLE_PERIOD, AUTO_RANGE_MARGIN, AUTO_RANGE_MIN, AUTO_RANGE_MAX, AUTO_RANGE_HISTORY,
+                      AUTO_RANGE_HYSTERESIS)
+
+SAMPLE_PERIOD_TICK = 25e-9  # seconds per sample_period count
+MAX_NUMBER_OF_SAMPLES = 1200
+
+
+def range_resolution(sample_period):
+    """Metres per range sample for a Ping360 sample period."""
+    return (WATER_SOS*sample_period*SAMPLE_PERIOD_TICK)/2
+
+
+def sonar_timing(max_range, sample_period=SAMPLE_PERIOD, max_samples=MAX_NUMBER_OF_SAMPLES):
+    """
+    Sample period and sample count that listen out to max_range.
+
+    The preferred sample period is kept and only the sample count shrinks. Ranges it cannot reach
+    in max_samples samples lengthen the sample period instead.
+    """
+    samples = math.ceil(max_range / range_resolution(sample_period))
+    if samples > max_samples:
+        sample_period = math.ceil(2*max_range / (max_samples*WATER_SOS*SAMPLE_PERIOD_TICK))
+        samples = max_samples
+    return sample_period, samples
+
+
+class AutoRange:
+    """
+    Picks the listening range from the furthest detection of the last few sweeps plus a margin.
+
+    A new range is only returned when it differs from the current one by more than the hysteresis
+    fraction, so the sonar settings do not change every sweep. Without any recent detection the
+    range opens up to max_range.
+    """
+
+    def __init__(self, margin=AUTO_RANGE_MARGIN, min_range=AUTO_RANGE_MIN, max_range=AUTO_RANGE_MAX,
+                 history=AUTO_RANGE_HISTORY, hysteresis=AUTO_RANGE_HYSTERESIS, initial_range=None):
+        self.margin = margin
+        self.min_range = min_range
+        self.max_range = max_range
+        self.hysteresis = hysteresis
+        self.furthest = deque(maxlen=history)
+        self.range = max_range if initial_range is None else initial_range
+
+    def update(self, mask, start_index, resolution):
+        """Fold in a sweep's (range x beam) CFAR mask, returns the new range or None to keep the current one."""
+        rows = np.flatnonzero(np.asarray(mask).any(axis=1))
+        self.furthest.append((start_index + rows[-1] + 1) * resolution if rows.size else None)
+
+        detections = [distance for distance in self.furthest if distance is not None]
+        target = max(detections) + self.margin if detections else self.max_range
+        target = min(max(target, self.min_range), self.max_range)
+
+        if abs(target - self.range) <= self.hysteresis * self.range:
+            return None
+
+        logger.info(f"Auto-range: {self.range:.1f} m -> {target:.1f} m")
+        self.range = target
+        return target
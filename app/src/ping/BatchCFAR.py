@@ -0,0 +1,216 @@
+"""
+Offline CFAR over recorded sonar sweeps.
+
+Fans the scans of one or more sonar_data_*.h5 recordings out across CPU cores and writes the CFAR
+masks and costmaps to a single output HDF5 file. Run from app/src:
+
+    python -m ping.BatchCFAR /app/sonar_data/sonar_data_*.h5 -o cfar.h5 --pfa 0.005 --ntc 30
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+import argparse
+import os
+import time
+
+import h5py
+import numpy as np
+from loguru import logger
+
+from .AutoRange import range_resolution
+from .BeamCleaner import near_field_cutoff
+from .ScanRecorder import is_chunked_recording, read_scans
+from .SonarFeatureExtraction import SonarFeatureExtraction
+
+from settings import SAMPLE_PERIOD, RECORDED_ANGLES, RECORDING_CHUNK_SCANS, Ntc, Ngc, Pfa
+
+# Per-process state set up by the pool initializer
+_extractor = None
+_resolution = None
+
+
+def _init_worker(ntc, ngc, pfa, rank, alg, resolution, stages):
+    global _extractor, _resolution
+    _extractor = SonarFeatureExtraction(Ntc=ntc, Ngc=ngc, Pfa=pfa, rank=rank, alg=alg)
+    if stages is not None:
+        _extractor.pipeline.configure(stages)
+    _resolution = resolution
+
+
+def list_groups(filename):
+    """
+    Split the scans of a recording into groups that are each read in one pass.
+
+    Chunked recordings are split along their HDF5 chunks, so every chunk is decompressed once. Scans
+    of older recordings are grouped RECORDING_CHUNK_SCANS dataset names at a time.
+    """
+    with h5py.File(filename, 'r') as file:
+        if is_chunked_recording(file):
+            scans = file["scans"]
+            step = scans.chunks[0] if scans.chunks else RECORDING_CHUNK_SCANS
+            return [range(start, min(start + step, len(scans))) for start in range(0, len(scans), step)]
+        names = [name for name, item in file.items() if isinstance(item, h5py.Dataset)]
+        return [names[i:i + RECORDING_CHUNK_SCANS] for i in range(0, len(names), RECORDING_CHUNK_SCANS)]
+
+
+def load_scans(file, refs):
+    """Yield the ref, cleaned scan, bearings and range resolution of every scan in refs."""
+    if isinstance(refs, range):
+        scans, angles, _, settings = read_scans(file, refs.start, refs.stop)
+        for ref, scan, scan_angles, row in zip(refs, scans, angles, settings):
+            # Auto-ranged recordings change the sample period from scan to scan
+            sample_period = int(row["sample_period"])
+            resolution = range_resolution(sample_period) if sample_period else _resolution
+            yield ref, scan[:row["num_ranges"]], scan_angles.tolist(), resolution
+        return
+
+    for ref in refs:
+        scan = file[ref][:]
+        yield ref, scan[near_field_cutoff(_resolution):], list(RECORDED_ANGLES), _resolution
+
+
+def process_scan(cleaned, bearings, resolution):
+    """Run CFAR and costmap projection on one cleaned scan inside a worker process."""
+    if cleaned.ndim != 2 or cleaned.shape[1] != len(bearings):
+        raise ValueError(f"scan shape {cleaned.shape} does not match {len(bearings)} bearings")
+
+    ctx = _extractor.pipeline.run(cleaned, bearings, resolution)
+
+    geometry = _extractor.get_geometry(bearings, resolution, len(ctx.image))
+    peaks = np.zeros(ctx.image.shape, dtype=np.uint8) if ctx.mask is None else ctx.mask
+    costmap = geometry.empty_costmap() if ctx.costmap is None else ctx.costmap
+
+    return peaks, costmap, geometry.x_range, geometry.y_range
+
+
+def process_group(filename, refs):
+    """
+    Process a group of scans, opening the recording once.
+
+    Returns (ref, result, error) for every scan, a scan that fails does not fail the rest of its group.
+    """
+    results = []
+    with h5py.File(filename, 'r') as file:
+        for ref, cleaned, bearings, resolution in load_scans(file, refs):
+            try:
+                results.append((ref, process_scan(cleaned, bearings, resolution), None))
+            except Exception as e:
+                results.append((ref, None, e))
+    return results
+
+
+def _write_result(out, filename, ref, peaks, costmap, x_range, y_range, compression):
+    name = f"scan_{ref:06d}" if isinstance(ref, int) else ref
+    group = out.require_group(os.path.basename(filename)).create_group(name)
+    group.create_dataset('mask', data=peaks, compression=compression)
+    group.create_dataset('costmap', data=costmap, compression=compression)
+    group.create_dataset('x', data=x_range)
+    group.create_dataset('y', data=y_range)
+    group.attrs['detections'] = int(np.count_nonzero(peaks))
+
+
+def run_batch(filenames, output, ntc=Ntc, ngc=Ngc, pfa=Pfa, rank=None, alg="GOCA", workers=None,
+              resolution=None, compression="gzip", report_every=50, stages=None):
+    """
+    Process every scan in filenames with a process pool and write the results to output.
+
+    At most two groups per worker are in flight, so only their results are held in memory until written.
+    Returns a summary dict with the scan, failure and detection counts and the throughput.
+    """
+    if resolution is None:
+        resolution = range_resolution(SAMPLE_PERIOD)
+
+    jobs = []
+    for filename in filenames:
+        if not os.path.exists(filename):
+            logger.error(f"File {filename} does not exist.")
+            continue
+        jobs.extend((filename, refs) for refs in list_groups(filename))
+
+    total = sum(len(refs) for _, refs in jobs)
+    max_in_flight = 2 * (workers or os.cpu_count() or 1)
+    logger.info(f"Batch CFAR: {total} scans from {len(filenames)} files, alg={alg}, Ntc={ntc}, Ngc={ngc}, Pfa={pfa}")
+
+    done = 0
+    failed = 0
+    detections = 0
+    reported = 0
+    start_time = time.perf_counter()
+
+    with h5py.File(output, 'w') as out, ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(ntc, ngc, pfa, rank, alg, resolution, stages)) as pool:
+        out.attrs.update({'Ntc': ntc, 'Ngc': ngc, 'Pfa': pfa, 'alg': alg, 'resolution': resolution})
+        if rank is not None:
+            out.attrs['rank'] = rank
+        if stages is not None:
+            out.attrs['stages'] = ",".join(stages)
+
+        pending = iter(jobs)
+        futures = {}
+        while True:
+            for filename, refs in islice(pending, max_in_flight - len(futures)):
+                futures[pool.submit(process_group, filename, refs)] = (filename, refs)
+            if not futures:
+                break
+
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                # Drop the future with its results as soon as they are written
+                filename, refs = futures.pop(future)
+                try:
+                    results = future.result()
+                except Exception as e:
+                    failed += len(refs)
+                    logger.error(f"Failed to process {filename}:{refs[0]}-{refs[-1]}: {e}")
+                    continue
+
+                for ref, result, error in results:
+                    if error is not None:
+                        failed += 1
+                        logger.error(f"Failed to process {filename}:{ref}: {error}")
+                        continue
+
+                    _write_result(out, filename, ref, *result, compression=compression)
+                    detections += int(np.count_nonzero(result[0]))
+                    done += 1
+
+                if done + failed - reported >= report_every or done + failed == total:
+                    reported = done + failed
+                    elapsed = time.perf_counter() - start_time
+                    logger.info(f"Processed {done + failed}/{total} scans ({done / elapsed:.1f} scans/s)")
+
+    elapsed = time.perf_counter() - start_time
+    summary = {
+        "scans": done,
+        "failed": failed,
+        "detections": detections,
+        "seconds": elapsed,
+        "scans_per_second": done / elapsed if elapsed > 0 else 0.0,
+    }
+    logger.info(
+        f"Batch CFAR finished: {done} scans, {failed} failed, {detections} detections in "
+        f"{elapsed:.1f} s ({summary['scans_per_second']:.1f} scans/s). Output: {output}")
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run CFAR over recorded sonar sweeps.")
+    parser.add_argument("files", nargs="+", help="sonar_data_*.h5 recordings")
+    parser.add_argument("-o", "--output", required=True, help="output HDF5 file")
+    parser.add_argument("--ntc", type=int, default=Ntc, help="number of training cells")
+    parser.add_argument("--ngc", type=int, default=Ngc, help="number of guard cells")
+    parser.add_argument("--pfa", type=float, default=Pfa, help="probability of false alarm")
+    parser.add_argument("--rank", type=int, default=None, help="OS-CFAR rank")
+    parser.add_argument("--alg", default="GOCA", help="CFAR algorithm")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--stages", default=None, help="comma separated pipeline stages (default: PIPELINE_STAGES)")
+    args = parser.parse_args()
+
+    stages = args.stages.split(",") if args.stages else None
+    run_batch(args.files, args.output, ntc=args.ntc, ngc=args.ngc, pfa=args.pfa, rank=args.rank,
+              alg=args.alg, workers=args.workers, stages=stages)
+
+
+if __name__ == "__main__":
+    main()
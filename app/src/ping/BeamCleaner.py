@@ -0,0 +1,112 @@
+from functools import lru_cache
+import math
+
+import numpy as np
+
+from settings import BLANKING_DISTANCE, TVG_SPREADING, TVG_ABSORPTION
+
+
+@lru_cache(maxsize=64)
+def near_field_cutoff(resolution, blanking_distance=BLANKING_DISTANCE):
+    """Index of the first range sample at or beyond the blanking distance."""
+    index = max(math.ceil(blanking_distance / resolution), 0)
+    # Settle float rounding so the result matches index*resolution >= blanking_distance exactly
+    while index > 0 and (index - 1)*resolution >= blanking_distance:
+        index -= 1
+    while index*resolution < blanking_distance:
+        index += 1
+    return index
+
+
+class BeamCleaner:
+    """
+    Drops the near-field samples of a beam or a (range x beam) matrix and applies the amplitude threshold
+    and time-varying gain in one pass.
+
+    The gain compensates spreading (TVG_SPREADING dB per decade of range) and absorption (TVG_ABSORPTION dB
+    per metre) and is applied before thresholding. Without gain the threshold on uint8 data is a 256 entry
+    lookup table, otherwise it runs through preallocated float buffers, so cleaning into a caller's out
+    array allocates nothing once the tables for a resolution and shape exist.
+    """
+
+    def __init__(self, blanking_distance=BLANKING_DISTANCE, tvg_spreading=TVG_SPREADING,
+                 tvg_absorption=TVG_ABSORPTION):
+        self.blanking_distance = blanking_distance
+        self.tvg_spreading = tvg_spreading
+        self.tvg_absorption = tvg_absorption
+
+        self._luts = {}
+        self._gains = {}
+        self._buffers = {}
+
+    @property
+    def tvg_enabled(self):
+        return bool(self.tvg_spreading or self.tvg_absorption)
+
+    def cutoff(self, resolution):
+        return near_field_cutoff(resolution, self.blanking_distance)
+
+    def _lut(self, threshold):
+        # Integer samples below a float threshold are exactly those below its ceiling
+        threshold = min(max(math.ceil(threshold), 0), 256)
+        lut = self._luts.get(threshold)
+        if lut is None:
+            lut = np.arange(256, dtype=np.uint8)
+            lut[:threshold] = 0
+            self._luts[threshold] = lut
+        return lut
+
+    def gain(self, resolution, num_ranges, start_index):
+        """Linear TVG gain for num_ranges samples starting at start_index."""
+        key = (resolution, num_ranges, start_index)
+        gain = self._gains.get(key)
+        if gain is None:
+            ranges = (start_index + np.arange(num_ranges)) * resolution
+            gain_db = self.tvg_spreading*np.log10(np.maximum(ranges, 1.0)) + self.tvg_absorption*ranges
+            gain = (10.0 ** (gain_db / 20.0)).astype(np.float32)
+            self._gains = {key: gain}  # only the current settings are worth keeping
+        return gain
+
+    def _work_buffers(self, shape):
+        buffers = self._buffers.get(shape)
+        if buffers is None:
+            buffers = np.empty(shape, dtype=np.float32), np.empty(shape, dtype=bool)
+            self._buffers[shape] = buffers
+        return buffers
+
+    def clean(self, data, resolution, threshold=0, out=None):
+        """
+        Clean a beam or a (range x beam) matrix, returning (cleaned, start_index).
+
+        cleaned is written into out when given. Without threshold or gain and without out it is a
+        view of data, data itself is never modified.
+        """
+        start_index = self.cutoff(resolution)
+        samples = data[start_index:]
+
+        if not threshold and not self.tvg_enabled:
+            if out is None:
+                return samples, start_index
+            np.copyto(out, samples, casting='unsafe')
+            return out, start_index
+
+        if out is None:
+            out = np.empty(samples.shape, dtype=np.uint8)
+
+        if not self.tvg_enabled and samples.dtype == np.uint8:
+            np.take(self._lut(threshold), samples, out=out, mode='clip')
+            return out, start_index
+
+        work, below = self._work_buffers(samples.shape)
+        if self.tvg_enabled:
+            gain = self.gain(resolution, len(samples), start_index)
+            if samples.ndim == 2:
+                gain = gain[:, np.newaxis]
+            np.multiply(samples, gain, out=work)
+        else:
+            np.copyto(work, samples, casting='unsafe')
+        np.minimum(work, 255, out=work)
+        np.less(work, threshold, out=below)
+        np.putmask(work, below, 0)
+        np.copyto(out, work, casting='unsafe')
+        return out, start_index
@@ -1,8 +1,12 @@
 import math
 import numpy as np
+from loguru import logger
 from scipy.optimize import root
 
 from . import cfar_utils
+from .ThresholdCache import threshold_cache
+
+from settings import CFAR2D_TRAIN_BEAMS, CFAR2D_GUARD_BEAMS
 
 
 class CFAR(object):
@@ -11,43 +15,47 @@ class CFAR(object):
         - Cell averaging (CA) CFAR
         - Greatest-of cell-averaging (GOCA) CFAR
         - Order statistic (OS) CFAR
+        - 2-D cell averaging (CA2D) and greatest-of (GOCA2D) CFAR over range x bearing
     """
 
-    def __init__(self, Ntc, Ngc, Pfa, rank=None):
+    def __init__(self, Ntc, Ngc, Pfa, rank=None, cache=None, train_beams=CFAR2D_TRAIN_BEAMS,
+                 guard_beams=CFAR2D_GUARD_BEAMS):
         self.Ntc = Ntc  # number of training cells
         assert self.Ntc % 2 == 0
         self.Ngc = Ngc  # number of guard cells
         assert self.Ngc % 2 == 0
         self.Pfa = Pfa  # false alarm rate
         if rank is None:  # matrix rank
-            self.rank = self.Ntc / 2
+            self.rank = self.Ntc // 2
         else:
             self.rank = rank
             assert 0 <= self.rank < self.Ntc
-
-        # threshold factor calculation for the 4 variants of CFAR
-        self.threshold_factor_CA = self.calc_WGN_threshold_factor_CA()
-        self.threshold_factor_SOCA = self.calc_WGN_threshold_factor_SOCA()
-        self.threshold_factor_GOCA = self.calc_WGN_threshold_factor_GOCA()
-        self.threshold_factor_OS = self.calc_WGN_threshold_factor_OS()
-
-        self.params = {
-            "CA": (self.Ntc // 2, self.Ngc // 2, self.threshold_factor_CA),
-            "SOCA": (self.Ntc // 2, self.Ngc // 2, self.threshold_factor_SOCA),
-            "GOCA": (self.Ntc // 2, self.Ngc // 2, self.threshold_factor_GOCA),
-            "OS": (self.Ntc // 2, self.Ngc // 2, self.rank, self.threshold_factor_OS),
+        self.train_beams = train_beams  # 2-D training cells on each side in bearing
+        self.guard_beams = guard_beams  # 2-D guard cells on each side in bearing
+
+        # threshold factors are computed on demand and shared through the cache
+        self.cache = threshold_cache if cache is None else cache
+        self.calculator = {
+            "CA": self.calc_WGN_threshold_factor_CA,
+            "SOCA": self.calc_WGN_threshold_factor_SOCA,
+            "GOCA": self.calc_WGN_threshold_factor_GOCA,
+            "OS": self.calc_WGN_threshold_factor_OS,
         }
         self.detector = {
             "CA": cfar_utils.ca,
             "SOCA": cfar_utils.soca,
             "GOCA": cfar_utils.goca,
             "OS": cfar_utils.os,
+            "CA2D": cfar_utils.ca_2d,
+            "GOCA2D": cfar_utils.goca_2d,
         }
         self.detector2 = {
             "CA": cfar_utils.ca2,
             "SOCA": cfar_utils.soca2,
             "GOCA": cfar_utils.goca2,
             "OS": cfar_utils.os2,
+            "CA2D": cfar_utils.ca_2d2,
+            "GOCA2D": cfar_utils.goca_2d2,
         }
 
     def __str__(self):
@@ -67,6 +75,47 @@ class CFAR(object):
             ]
         )
 
+    @property
+    def threshold_factor_CA(self):
+        return self.threshold_factor("CA")
+
+    @property
+    def threshold_factor_SOCA(self):
+        return self.threshold_factor("SOCA")
+
+    @property
+    def threshold_factor_GOCA(self):
+        return self.threshold_factor("GOCA")
+
+    @property
+    def threshold_factor_OS(self):
+        return self.threshold_factor("OS")
+
+    def threshold_factor(self, alg):
+        """
+        Return the threshold factor of one CFAR variant, solving for it only on a cache miss.
+        """
+        if alg.endswith("2D"):
+            # The 2-D ring has the statistics of a 1-D window with as many training cells
+            base_alg = alg[:-2]
+            train_cells = 2 * cfar_utils._training_cells_2d(
+                self.Ntc // 2, self.Ngc // 2, self.train_beams, self.guard_beams)
+            return CFAR(train_cells, 0, self.Pfa, cache=self.cache).threshold_factor(base_alg)
+
+        key = (alg, self.Ntc, self.Pfa, self.rank if alg == "OS" else None)
+        return self.cache.get(key, self.calculator[alg])
+
+    def is_range_only(self, alg):
+        """True when a cell's detection only depends on samples of its own beam."""
+        return alg in self.detector and not alg.endswith("2D")
+
+    def get_params(self, alg):
+        if alg.endswith("2D"):
+            return (self.Ntc // 2, self.Ngc // 2, self.train_beams, self.guard_beams, self.threshold_factor(alg))
+        if alg == "OS":
+            return (self.Ntc // 2, self.Ngc // 2, self.rank, self.threshold_factor(alg))
+        return (self.Ntc // 2, self.Ngc // 2, self.threshold_factor(alg))
+
     def calc_WGN_threshold_factor_CA(self):
         return self.Ntc * (self.Pfa ** (-1.0 / self.Ntc) - 1)
 
@@ -96,13 +145,18 @@ class CFAR(object):
 
     def calc_WGN_pfa_GOSOCA_core(self, x):
         x = float(x)
+        base = 2 + x / (self.Ntc / 2)
         temp = 0.0
         for k in range(int(self.Ntc / 2)):
             l1 = math.lgamma(self.Ntc / 2 + k)
             l2 = math.lgamma(k + 1)
             l3 = math.lgamma(self.Ntc / 2)
-            temp += math.exp(l1 - l2 - l3) * (2 + x / (self.Ntc / 2)) ** (-k)
-        return temp * (2 + x / (self.Ntc / 2)) ** (-self.Ntc / 2)
+            if base > 0:
+                # Summed in the log domain, the binomial terms overflow for large (2-D) windows
+                temp += math.exp(l1 - l2 - l3 - (k + self.Ntc / 2) * math.log(base))
+            else:
+                temp += math.exp(l1 - l2 - l3) * base ** (-k - self.Ntc / 2)
+        return temp
 
     def calc_WGN_pfa_SOCA(self, x):
         return self.calc_WGN_pfa_GOSOCA_core(x) - self.Pfa / 2
@@ -123,10 +177,33 @@ class CFAR(object):
         """
         Return target mask array.
         """
-        return self.detector[alg](mat, *self.params[alg])
+        return self.detector[alg](mat, *self.get_params(alg))
 
     def detect2(self, mat, alg="CA"):
         """
         Return target mask array and threshold array.
         """
-        return self.detector2[alg](mat, *self.params[alg])
+        return self.detector2[alg](mat, *self.get_params(alg))
+
+
+def warm_up_threshold_factors(grid, cache=None):
+    """
+    Solve and cache threshold factors for every combination in a parameter grid.
+
+    The grid maps "alg", "Ntc", "Pfa" and optionally "rank" to lists of values;
+    Ngc does not affect the factor and a rank of None selects Ntc // 2.
+    """
+    count = 0
+    for Ntc in grid["Ntc"]:
+        for Pfa in grid["Pfa"]:
+            for rank in grid.get("rank", [None]):
+                if rank is not None and not 0 <= rank < Ntc:
+                    continue
+                detector = CFAR(Ntc, 0, Pfa, rank, cache)
+                for alg in grid["alg"]:
+                    try:
+                        detector.threshold_factor(alg)
+                        count += 1
+                    except ValueError as e:
+                        logger.warning(f"CFAR warm-up skipped {alg} Ntc={Ntc} Pfa={Pfa}: {e}")
+    return count
@@ -1,14 +1,20 @@
 from typing import Optional, Callable
 import asyncio
 import os
-import h5py
+import time
 import numpy as np
 from brping import Ping360
-from brping import definitions
 from loguru import logger
+from .AutoRange import AutoRange, range_resolution, sonar_timing
+from .BeamCleaner import BeamCleaner
+from .PingTransport import PingSweepError, PingTransport
+from .ScanReplay import ScanReplay
+from .ScanScheduler import AdaptiveScanScheduler, sector_steps
 from .SonarFeatureExtraction import SonarFeatureExtraction
+from .SweepBuffer import SweepBuffer
 
-from settings import WATER_SOS, TRANSMIT_DURATION, TRANSMIT_FREQUENCY, SAMPLE_PERIOD, Ntc, Ngc, Pfa
+from settings import TRANSMIT_DURATION, TRANSMIT_FREQUENCY, SAMPLE_PERIOD, NUMBER_OF_SAMPLES, Ntc, Ngc, Pfa, STREAMING_CFAR, RECORDED_ANGLES, \
+    REPLAY_SPEED, REPLAY_LOOP, SCAN_MODE, AUTO_RANGE, SWEEP_RESTARTS, PING_RETRY_BACKOFF
 
 
 class PingManager:
@@ -29,104 +35,143 @@ class PingManager:
             except:
                 logger.error("Failed to initialize Ping!")
                 exit(1)
+
+            # All further device I/O goes through the transport's thread
+            self.transport = PingTransport(self.myPing360)
         else:
-            self.angles = [334.8, 335.7, 336.6, 337.5, 338.4, 339.3, 340.2, 341.1, 342,  342.9, 343.8, 344.7,
-                           345.6, 346.5, 347.4, 348.3, 349.2, 350.1, 351,  351.9, 352.8, 353.7, 354.6, 355.5,
-                           356.4, 357.3, 358.2, 359.1,   0,    0.9,   1.8,   2.7,   3.6,   4.5,   5.4,   6.3,
-                           7.2,   8.1,   9,    9.9,  10.8,  11.7,  12.6,  13.5,  14.4,  15.3,  16.2,  17.1,
-                           18,   18.9,  19.8,  20.7,  21.6,  22.5,  23.4,  24.3]
+            self.transport = None
+            self.angles = RECORDED_ANGLES
 
         self.feature_extractor = SonarFeatureExtraction(
             Ntc=Ntc, Ngc=Ngc, Pfa=Pfa, alg="GOCA")
         self.features = None
 
+        self.current_scan = None
+        self.current_angles = None
+        self.start_index = 0
+        self.sweep_buffer = None
+
         self.costmap = None
         self.X = None
         self.Y = None
 
-        self.resolution = (WATER_SOS*SAMPLE_PERIOD*25e-9)/2
+        self.transmit_duration = TRANSMIT_DURATION
+        self.sample_period = SAMPLE_PERIOD
+        self.number_of_samples = NUMBER_OF_SAMPLES
+        self.transmit_frequency = TRANSMIT_FREQUENCY
+        self.resolution = range_resolution(self.sample_period)
+        self.scan_resolution = self.resolution  # resolution of current_scan
+        self.cleaner = BeamCleaner()
+        self.auto_range = None
 
-        # Callback function for when current_scan is updated
+        self.scan_mode = None
+        self.sweep_count = 0
+        self.beams_per_second = 0.0
+
+        # Callback function for when current_scan is updated, called with (scan, angles, settings)
         self._on_scan_updated_callback: Optional[Callable[[
-            np.ndarray], None]] = None
+            np.ndarray, list, dict], None]] = None
 
     async def shutdown(self):
-        if self.device is not None:
-            self.myPing360.connect_serial(self.device, self.baudrate)
+        if self.transport is None:
+            return
 
         # turn the motor off
-        self.myPing360.control_motor_off()
+        if self.transport.running:
+            await self.transport.call(self.myPing360.control_motor_off)
+            await asyncio.to_thread(self.transport.stop)
+        else:
+            self.myPing360.control_motor_off()
 
         logger.info("Ping360 shutting down")
 
-    def register_scan_update_callback(self, callback: Callable[[np.ndarray], None]):
+    def register_scan_update_callback(self, callback: Callable[[np.ndarray, list, dict], None]):
         """Register a callback function to be called when current_scan is updated."""
         self._on_scan_updated_callback = callback
         logger.info("Sonar callback registered.")
 
+    def get_transducer_settings(self, transmit_duration=None, sample_period=None, transmit_frequency=None):
+        return {
+            "mode": 1,
+            "gain_setting": 0,
+            "transmit_duration": self.transmit_duration if transmit_duration is None else transmit_duration,
+            "sample_period": self.sample_period if sample_period is None else sample_period,
+            "transmit_frequency": self.transmit_frequency if transmit_frequency is None else transmit_frequency,
+            "number_of_samples": self.number_of_samples,
+            "transmit": 1,
+            "reserved": 0,
+        }
+
     async def scan(self, angle, transmit_duration, sample_period, transmit_frequency):
-        self.myPing360.control_transducer(
-            mode=1,
-            gain_setting=0,
-            angle=angle,
-            transmit_duration=transmit_duration,
-            sample_period=sample_period,
-            transmit_frequency=transmit_frequency,
-            number_of_samples=1200,
-            transmit=1,
-            reserved=0
-        )
+        """Queue a transducer request on the I/O thread, the reply is collected by get_ping_data."""
+        self.transport.start()
+        self.transport.request(
+            angle=angle, **self.get_transducer_settings(transmit_duration, sample_period, transmit_frequency))
 
     async def get_ping_data(self):
-        # Print the scanning head angle
-
-        m = self.myPing360.wait_message(
-            [definitions.PING360_DEVICE_DATA])
-        if m:
-            self.data = ({
-                "mode": m.mode,
-                "gain_setting": m.gain_setting,
-                "angle": m.angle * (180 / 200),
-                "transmit_duration": m.transmit_duration,
-                "sample_period": m.sample_period,
-                "transmit_frequency": m.transmit_frequency,
-                "number_of_samples": m.number_of_samples,
-                "data": np.frombuffer(m.data, dtype=np.uint8),
-            })
-
-            return self.data['angle'], np.array(self.data['data'])
+        # Wait for the I/O thread to hand over the next beam without blocking the loop
+        self.data = await self.transport.get_beam()
+        if self.data:
+            # Read-only view of the message payload, cleaning copies it into the sweep buffer
+            return self.data['angle'], self.data['data']
 
         return None, None
 
-    async def read_recording(self, filename):
+    async def read_recording(self, filename, speed=REPLAY_SPEED, loop=REPLAY_LOOP, start=0):
         logger.info("Reading sonar data.")
-        if os.path.exists(filename):
-            with h5py.File(filename, 'r') as file:
-                # List all saved scans
-                datasets = list(file.keys())
-                logger.info(f"Found scans: {datasets}")
-
-                for dataset in datasets:
-                    if datasets:
-                        self.current_scan, self.start_index = self.clean(
-                            file[dataset][:])
-                        logger.debug(
-                            f"Max: {np.max(self.current_scan)}, Min: {np.min(self.current_scan)}")
-                        self.current_angles = self.angles
-                        self.costmap, self.X, self.Y = await self.feature_extractor.extract_features(self.current_scan, self.angles, self.resolution)
-                    else:
-                        logger.warning("No scans found in file.")
-                    await asyncio.sleep(15)
-        else:
+        if not os.path.exists(filename):
             logger.error(f"File {filename} does not exist.")
             return None
 
+        with ScanReplay(filename, speed=speed, loop=loop) as replay:
+            if len(replay) == 0:
+                logger.warning("No scans found in file.")
+                return None
+
+            replay.seek(start)
+            async for record in replay:
+                if record.sample_period:
+                    self.sample_period = record.sample_period
+                    self.resolution = range_resolution(self.sample_period)
+                self.scan_resolution = self.resolution
+                if record.cleaned:
+                    self.current_scan, self.start_index = record.scan, record.start_index
+                else:
+                    self.current_scan, self.start_index = self.clean(record.scan)
+                logger.debug(
+                    f"Max: {np.max(self.current_scan)}, Min: {np.min(self.current_scan)}")
+                self.current_angles = record.angles
+                self.costmap, self.X, self.Y = await self.feature_extractor.extract_features(
+                    self.current_scan, self.current_angles, self.resolution)
+
+    def get_sonar_settings(self):
+        return {
+            "transmit_duration": self.transmit_duration,
+            "sample_period": self.sample_period,
+            "transmit_frequency": self.transmit_frequency,
+            "number_of_samples": self.number_of_samples,
+            "start_index": self.start_index,
+        }
+
+    def set_range(self, max_range):
+        """Listen out to max_range metres, the new settings apply from the next request."""
+        self.sample_period, self.number_of_samples = sonar_timing(max_range)
+        self.resolution = range_resolution(self.sample_period)
+        logger.info(f"Sonar range {max_range:.1f} m: sample_period={self.sample_period}, "
+                    f"number_of_samples={self.number_of_samples}, resolution={self.resolution:.4f} m")
+
     def get_data(self):
         return self.current_scan
 
     def get_costmap(self):
         return self.costmap, self.X, self.Y
 
+    async def get_cartesian_scan(self):
+        if self.current_scan is None or self.current_angles is None:
+            return None, None, None
+        return await self.feature_extractor.warp_to_cartesian(
+            self.current_scan, self.current_angles, self.scan_resolution)
+
     def get_current_angles(self):
         return self.current_angles
 
@@ -136,55 +181,249 @@ class PingManager:
     def get_start_index(self):
         return self.start_index
 
-    def clean(self, data):
-        """Sonar data below operating range get set to zero."""
-        index = 0
-        while index*self.resolution < 0.75:
-            data[index] = 0
-            index += 1
-
-        return data[index:], index
-
-    async def sonar_scanning(self, start=0, end=399, threshold=80):
+    def get_scan_resolution(self):
+        return self.scan_resolution
+
+    def get_scan_stats(self):
+        stats = {"mode": self.scan_mode, "sweeps": self.sweep_count,
+                 "beams_per_second": round(self.beams_per_second, 2)}
+        if self.transport is not None:
+            stats["transport"] = self.transport.get_stats()
+        return stats
+
+    def clean(self, data, threshold=0, out=None):
+        """
+        Drop sonar data below operating range and zero samples under threshold, returning (cleaned, start_index).
+
+        Works on a beam or a (range x beam) matrix and never modifies data. Without a threshold or TVG the
+        result is a view, otherwise it is written into out (allocated when None).
+        """
+        return self.cleaner.clean(data, self.resolution, threshold, out)
+
+    async def sonar_scanning(self, start=0, end=399, threshold=80, streaming=STREAMING_CFAR, mode=SCAN_MODE,
+                             auto_range=AUTO_RANGE):
+        """
+        Sweep the sector [start, end] in gradians.
+
+        In "request" mode every step waits for its data message before the next request is sent. In
+        "pipelined" mode the I/O thread sends the next request as soon as a data message arrives, and
+        "auto" hands the sweep to the firmware's auto-transmit mode when it supports it. "adaptive"
+        requests steps one at a time as planned by AdaptiveScanScheduler from the previous sweep's CFAR.
+
+        With streaming enabled each beam runs through CFAR as soon as it arrives and updates the
+        rolling polar mask and costmap, otherwise (or when the feature extractor's pipeline has stages
+        that need the whole sweep) the pipeline runs once on the full sweep. With auto_range
+        the sample period and count are picked from the furthest recent detection at every sweep boundary.
+        """
+        assert mode in ("request", "pipelined", "auto", "adaptive")
+        self.auto_range = AutoRange(initial_range=self.number_of_samples*self.resolution) if auto_range else None
         self.current_scan = None
         self.current_angles = None
-        data_mat = []
-        angles = []
-        range = []
-
         self.start_index = 0
+        self.scan_mode = mode
+
+        steps = sector_steps(start, end)
+        sector_bearings = [step * 0.9 for step in steps]
+
+        if mode == "request":
+            await self._request_sweeps(steps, sector_bearings, threshold, streaming)
+        elif mode == "adaptive":
+            await self._adaptive_sweeps(steps, sector_bearings, threshold, streaming)
+        else:
+            await self._continuous_sweeps(steps, sector_bearings, threshold, streaming, auto=mode == "auto")
+
+    async def _request_sweeps(self, sector_steps, sector_bearings, threshold, streaming):
+        start, end = sector_steps[0], sector_steps[-1]
+        self.sweep_buffer = SweepBuffer(sector_bearings)
+        beams = 0
+        sweep_started = time.monotonic()
 
         step = start
         while True:
-            await self.scan(step, TRANSMIT_DURATION,
-                            SAMPLE_PERIOD, TRANSMIT_FREQUENCY)
-            data, angle = await self.get_ping_data()
+            angle, data = await self._request_beam(step)
 
             if data is None:
                 logger.warning(f"Ping360 message empty at step {step}!")
+            else:
+                self._process_beam((step - start) % 400, angle, data, threshold, sector_bearings, streaming)
+                beams += 1
+
+            # A missing reply still advances the head, wrapping at the end of the sector
+            if step == end:
+                step = start
+                if beams:
+                    await self._complete_sweep(streaming, time.monotonic() - sweep_started, beams)
+                beams = 0
+                sweep_started = time.monotonic()
+            else:
                 step = (step + 1) % 400
-                continue
 
-            # Remove data out of operating range and identify starting index
-            cleaned_data, self.start_index = self.clean(data)
+            await asyncio.sleep(0)
 
-            # Apply a conservatively high amplitude threshold
-            cleaned_data[cleaned_data < threshold] = 0
+    async def _request_beam(self, step):
+        """
+        Request one step and wait for its beam, retrying a failed request after a growing delay.
 
-            data_mat.append(cleaned_data)
-            angles.append(angle)
+        Raises PingSweepError once SWEEP_RESTARTS retries in a row failed.
+        """
+        min_delay, max_delay = PING_RETRY_BACKOFF
+        delay = min_delay
+        failures = 0
+        while True:
+            await self.scan(step, self.transmit_duration,
+                            self.sample_period, self.transmit_frequency)
+            try:
+                return await self.get_ping_data()
+            except PingSweepError as e:
+                failures += 1
+                if failures > SWEEP_RESTARTS:
+                    logger.error(f"{e}, giving up after {SWEEP_RESTARTS} retries.")
+                    raise
+                logger.error(f"{e}, retrying in {delay:.1f} s ({failures}/{SWEEP_RESTARTS}).")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+    async def _continuous_sweeps(self, sector_steps, sector_bearings, threshold, streaming, auto=False):
+        """
+        Let the I/O thread keep the transducer busy and consume beams as they arrive.
+
+        Beams are placed by their reported angle. A sweep is complete when the head reaches either end
+        of the sector, which also covers firmware that sweeps a sector back and forth.
+        """
+        start, end = sector_steps[0], sector_steps[-1]
+        sector = set(sector_steps)
+        self.sweep_buffer = SweepBuffer(sector_bearings)
+        first_step = None
+        beams = 0
+        sweep_started = time.monotonic()
+
+        self.transport.start()
+        self.transport.start_sweep(sector_steps, self.get_transducer_settings(), auto=auto)
+        min_delay, max_delay = PING_RETRY_BACKOFF
+        delay = min_delay
+        failures = 0
+        try:
+            while True:
+                try:
+                    angle, data = await self.get_ping_data()
+                except PingSweepError as e:
+                    failures += 1
+                    if failures > SWEEP_RESTARTS:
+                        logger.error(f"{e}, giving up after {SWEEP_RESTARTS} restarts.")
+                        raise
+                    logger.error(f"{e}, restarting sweep in {delay:.1f} s ({failures}/{SWEEP_RESTARTS}).")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, max_delay)
+                    self.transport.start_sweep(sector_steps, self.get_transducer_settings(), auto=auto)
+                    first_step = None
+                    beams = 0
+                    sweep_started = time.monotonic()
+                    continue
+
+                if data is None:
+                    logger.warning("Ping360 message empty during sweep!")
+                    continue
+                failures = 0
+                delay = min_delay
+
+                step = int(round(angle / 0.9)) % 400
+                if step not in sector:
+                    continue
+                if self.data["sample_period"] != self.sample_period or len(data) != self.number_of_samples:
+                    # Still in flight from before a range change
+                    continue
+
+                if beams == 0:
+                    first_step = step
+                self._process_beam((step - start) % 400, angle, data, threshold, sector_bearings, streaming)
+                beams += 1
+
+                if step in (start, end) and step != first_step:
+                    transducer = self.get_transducer_settings()
+                    await self._complete_sweep(streaming, time.monotonic() - sweep_started, beams)
+                    if self.get_transducer_settings() != transducer:
+                        self.transport.start_sweep(sector_steps, self.get_transducer_settings(), auto=auto)
+                    beams = 0
+                    sweep_started = time.monotonic()
+        finally:
+            self.transport.stop_sweep()
+
+    async def _adaptive_sweeps(self, sector_steps, sector_bearings, threshold, streaming):
+        """
+        Sweep the steps planned by the scheduler, refining around the previous sweep's detections.
+
+        Every sweep hands on the full sector, bearings that were skipped keep their latest beam.
+        """
+        start = sector_steps[0]
+        scheduler = AdaptiveScanScheduler(start, sector_steps[-1])
+        self.sweep_buffer = SweepBuffer(sector_bearings)
+        beam_settings = None
 
-            if step == end:
-                step = start
-                self.current_scan = np.array(data_mat).T
-                self.current_angles = angles
+        while True:
+            if (self.sample_period, self.number_of_samples) != beam_settings:
+                # The range changed, beams from the old settings no longer line up
+                if self.sweep_buffer.num_ranges is not None:
+                    self.sweep_buffer.reset(self.sweep_buffer.num_ranges)
+                beam_settings = (self.sample_period, self.number_of_samples)
 
-                if self._on_scan_updated_callback:
-                    self._on_scan_updated_callback(self.current_scan)
+            plan = scheduler.plan()
+            sweep_started = time.monotonic()
 
-                data_mat = []
-                angles = []
-            else:
-                step = (step + 1) % 400
+            for step in plan:
+                angle, data = await self._request_beam(step)
+
+                if data is None:
+                    logger.warning(f"Ping360 message empty at step {step}!")
+                    continue
+
+                self._process_beam((step - start) % 400, angle, data, threshold, sector_bearings, streaming)
+                await asyncio.sleep(0)
+
+            visited = np.flatnonzero(self.sweep_buffer.written)
+            if visited.size == 0:
+                continue
 
-            asyncio.sleep(0.1)
+            await self._complete_sweep(streaming, time.monotonic() - sweep_started, len(plan))
+
+            mask = self.feature_extractor.get_cfar()
+            if mask is not None:
+                scheduler.update([sector_steps[column] for column in visited], mask.any(axis=0)[visited])
+
+    def _process_beam(self, column, angle, data, threshold, sector_bearings, streaming):
+        # Remove data out of operating range and apply a conservatively high amplitude threshold,
+        # straight into the beam's column of the sweep buffer
+        target = self.sweep_buffer.column(column, len(data) - self.cleaner.cutoff(self.resolution), angle)
+        beam, self.start_index = self.clean(data, threshold, out=target)
+
+        if streaming and self.feature_extractor.pipeline.streamable:
+            if not self.feature_extractor.stream_matches(sector_bearings, len(beam), self.resolution):
+                self.feature_extractor.start_stream(
+                    sector_bearings, len(beam), self.resolution)
+            self.feature_extractor.update_beam(column, beam, self.resolution)
+            self.costmap, self.X, self.Y = self.feature_extractor.get_stream_costmap()
+
+    async def _complete_sweep(self, streaming, elapsed, beams):
+        # The completed sweep is handed on without copying, it stays valid until the next swap
+        self.current_scan = self.sweep_buffer.swap()
+        self.current_angles = self.sweep_buffer.front_angles.tolist()
+
+        self.sweep_count += 1
+        if elapsed > 0:
+            self.beams_per_second = beams / elapsed
+        logger.info(f"Sweep {self.sweep_count} ({self.scan_mode}): {beams} beams at "
+                    f"{self.beams_per_second:.1f} beams/s")
+
+        if not (streaming and self.feature_extractor.pipeline.streamable):
+            self.costmap, self.X, self.Y = await self.feature_extractor.extract_features(
+                self.current_scan, self.current_angles, self.resolution)
+
+        self.scan_resolution = self.resolution
+
+        if self._on_scan_updated_callback:
+            self._on_scan_updated_callback(
+                self.current_scan, self.current_angles, self.get_sonar_settings())
+
+        if self.auto_range is not None and self.feature_extractor.get_cfar() is not None:
+            max_range = self.auto_range.update(self.feature_extractor.get_cfar(), self.start_index, self.resolution)
+            if max_range is not None:
+                self.set_range(max_range)
@@ -0,0 +1,240 @@
+from typing import Optional
+import asyncio
+import queue
+import threading
+import time
+
+import numpy as np
+from brping import definitions
+from loguru import logger
+
+from settings import PING_REPLY_TIMEOUT
+
+
+class PingSweepError(RuntimeError):
+    """A sweep or transducer request failed on the I/O thread, raised to the consumer through get_beam."""
+
+
+class PingTransport:
+    """
+    Runs every blocking Ping360 call on a dedicated I/O thread.
+
+    The event loop only enqueues commands and awaits beams, which the I/O thread hands back
+    through an asyncio queue. Nothing on the loop ever waits on the serial or UDP link.
+    """
+
+    def __init__(self, device, reply_timeout=PING_REPLY_TIMEOUT, queue_size=64):
+        self.device = device
+        self.reply_timeout = reply_timeout
+        self.queue_size = queue_size
+
+        self.commands = queue.Queue()
+        self.beams: Optional[asyncio.Queue] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread = None
+
+        # Continuous sweep state, owned by the I/O thread
+        self.sweep_stop = threading.Event()
+        self.sweep_mode = None
+        self.sweep_beams = 0
+        self.sweep_started = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """Start the I/O thread, delivering beams to the running event loop."""
+        if self.running:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.beams = asyncio.Queue(maxsize=self.queue_size)
+        self.thread = threading.Thread(target=self._run, name="ping360-io", daemon=True)
+        self.thread.start()
+        logger.info("Ping360 I/O thread started.")
+
+    def stop(self):
+        if self.running:
+            self.commands.put(None)
+            self.thread.join()
+        self.thread = None
+
+    def request(self, **transducer):
+        """Queue a control_transducer command, its data message arrives through get_beam."""
+        self.commands.put(("transducer", transducer))
+
+    def start_sweep(self, steps, transducer, auto=False):
+        """
+        Sweep the given steps (gradians) continuously on the I/O thread.
+
+        In pipelined mode the next transducer request goes out as soon as the previous data message
+        arrives, before the beam is handed to the loop. With auto set the firmware's auto-transmit
+        mode is tried first and the sweep falls back to pipelined when the device does not answer it.
+        The sweep runs until stop_sweep or until another command is queued.
+        """
+        self.sweep_stop.clear()
+        self.commands.put(("sweep", (list(steps), dict(transducer), auto)))
+
+    def stop_sweep(self):
+        self.sweep_stop.set()
+
+    @property
+    def beams_per_second(self):
+        if not self.sweep_started or self.sweep_beams == 0:
+            return 0.0
+        return self.sweep_beams / (time.monotonic() - self.sweep_started)
+
+    def get_stats(self):
+        return {
+            "mode": self.sweep_mode,
+            "beams": self.sweep_beams,
+            "beams_per_second": round(self.beams_per_second, 2),
+        }
+
+    async def call(self, function, *args, **kwargs):
+        """Run any other device call on the I/O thread and await its result."""
+        future = self.loop.create_future()
+        self.commands.put(("call", (function, args, kwargs, future)))
+        return await future
+
+    async def get_beam(self):
+        """
+        Wait for the next beam, None when the device did not answer a request.
+
+        Raises PingSweepError when the request or the continuous sweep failed, after the beams it delivered.
+        """
+        beam = await self.beams.get()
+        if isinstance(beam, PingSweepError):
+            raise beam
+        return beam
+
+    def _deliver(self, beam):
+        if self.beams.full():
+            # The consumer fell behind, keep the most recent beams
+            self.beams.get_nowait()
+            logger.warning("Ping360 beam queue full, dropped the oldest beam.")
+        self.beams.put_nowait(beam)
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _receive(self, message_id=definitions.PING360_DEVICE_DATA, timeout=None):
+        m = self.device.wait_message([message_id], self.reply_timeout if timeout is None else timeout)
+        if not m:
+            return None
+        return {
+            "mode": m.mode,
+            "gain_setting": m.gain_setting,
+            "angle": m.angle * (180 / 200),
+            "transmit_duration": m.transmit_duration,
+            "sample_period": m.sample_period,
+            "transmit_frequency": m.transmit_frequency,
+            "number_of_samples": m.number_of_samples,
+            "data": np.frombuffer(m.data, dtype=np.uint8),
+        }
+
+    def _run(self):
+        while True:
+            command = self.commands.get()
+            if command is None:
+                break
+
+            kind, payload = command
+            if kind == "transducer":
+                try:
+                    self.device.control_transducer(**payload)
+                    beam = self._receive()
+                except Exception as e:
+                    beam = PingSweepError(f"Ping360 transducer request failed: {e}")
+                    beam.__cause__ = e
+                self.loop.call_soon_threadsafe(self._deliver, beam)
+            elif kind == "sweep":
+                try:
+                    self._sweep(*payload)
+                except Exception as e:
+                    logger.error(f"Ping360 sweep failed: {e}")
+                    # The consumer is waiting for beams, hand it the failure instead
+                    error = PingSweepError(f"Ping360 sweep failed: {e}")
+                    error.__cause__ = e
+                    self.loop.call_soon_threadsafe(self._deliver, error)
+                finally:
+                    self.sweep_mode = None
+            elif kind == "call":
+                function, args, kwargs, future = payload
+                result, error = None, None
+                try:
+                    result = function(*args, **kwargs)
+                except Exception as e:
+                    error = e
+                self.loop.call_soon_threadsafe(self._resolve, future, result, error)
+
+        logger.info("Ping360 I/O thread stopped.")
+
+    def _sweep_interrupted(self):
+        return self.sweep_stop.is_set() or not self.commands.empty()
+
+    def _count_beam(self, beam):
+        if beam is not None:
+            self.sweep_beams += 1
+        self.loop.call_soon_threadsafe(self._deliver, beam)
+
+    def _sweep(self, steps, transducer, auto):
+        self.sweep_beams = 0
+        self.sweep_started = time.monotonic()
+
+        if auto and self._auto_sweep(steps, transducer):
+            return
+
+        self.sweep_mode = "pipelined"
+        logger.info(f"Ping360 pipelined sweep over {len(steps)} steps.")
+        index = 0
+        self.device.control_transducer(angle=steps[index], **transducer)
+        while True:
+            beam = self._receive()
+            if self._sweep_interrupted():
+                self._count_beam(beam)
+                break
+
+            # Next request goes out before the beam is handed over, so the device never idles
+            index = (index + 1) % len(steps)
+            self.device.control_transducer(angle=steps[index], **transducer)
+            self._count_beam(beam)
+
+    def _auto_sweep(self, steps, transducer):
+        """Run the sweep in auto-transmit mode, False when the firmware does not support it."""
+        step_size = steps[1] - steps[0] if len(steps) > 1 else 1
+        self.device.control_auto_transmit(
+            mode=transducer["mode"],
+            gain_setting=transducer["gain_setting"],
+            transmit_duration=transducer["transmit_duration"],
+            sample_period=transducer["sample_period"],
+            transmit_frequency=transducer["transmit_frequency"],
+            number_of_samples=transducer["number_of_samples"],
+            start_angle=steps[0],
+            stop_angle=steps[-1],
+            num_steps=step_size % 400,
+            delay=0,
+        )
+
+        beam = self._receive(definitions.PING360_AUTO_DEVICE_DATA, timeout=4 * self.reply_timeout)
+        if beam is None:
+            logger.warning("Ping360 did not answer auto-transmit, falling back to pipelined sweep.")
+            return False
+
+        self.sweep_mode = "auto"
+        logger.info(f"Ping360 auto-transmit sweep from {steps[0]} to {steps[-1]}.")
+        while True:
+            self._count_beam(beam)
+            if self._sweep_interrupted():
+                break
+            beam = self._receive(definitions.PING360_AUTO_DEVICE_DATA)
+
+        # Any other command ends auto-transmit, the motor off also stops the head
+        self.device.control_motor_off()
+        return True
@@ -1,42 +1,263 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import h5py
+import numpy as np
+import queue
+import threading
 import time
 import os
 
 from loguru import logger
 
-from settings import SONAR_FILEPATH
+from settings import (SONAR_FILEPATH, RECORDING_COMPRESSION, RECORDING_COMPRESSION_LEVEL, RECORDING_CHUNK_SCANS,
+                      RECORDING_QUEUE_SIZE, RECORDING_BACKPRESSURE)
+
+RECORDING_FORMAT_VERSION = 2
+
+# Sonar settings stored alongside every scan
+SETTINGS_DTYPE = np.dtype([
+    ("transmit_duration", np.uint16),
+    ("sample_period", np.uint16),
+    ("transmit_frequency", np.uint16),
+    ("number_of_samples", np.uint16),
+    ("start_index", np.uint16),
+    ("num_ranges", np.uint16),
+])
+
+
+def is_chunked_recording(file):
+    """True for recordings with a single extendable scan dataset, False for one dataset per scan."""
+    return isinstance(file.get("scans"), h5py.Dataset)
+
+
+def read_scans(file, start=0, stop=None):
+    """
+    Read a window of scans from a chunked recording.
+
+    Every array is a single slice of its dataset: scans (scan x range x beam), angles
+    (scan x beam), timestamps (scan) and settings (scan, SETTINGS_DTYPE).
+    """
+    window = slice(start, stop)
+    return file["scans"][window], file["angles"][window], file["timestamps"][window], file["settings"][window]
 
 
 class SonarRecorder:
-    def __init__(self):
+    """
+    Record sonar scans to HDF5 from a background writer thread.
+
+    save_scan only queues the scan, so compression and disk I/O never run on the event loop. When
+    the bounded queue is full the oldest queued scan is dropped ("drop_oldest") or the scan waits for
+    room ("block"). Blocked scans wait, in order, on a feeder thread rather than in the caller, so a
+    writer that falls behind never stalls the loop; they are counted as waiting until queued. At most
+    queue_size scans wait, further scans are dropped until the writer catches up.
+    """
+
+    def __init__(self, compression=RECORDING_COMPRESSION, compression_level=RECORDING_COMPRESSION_LEVEL,
+                 chunk_scans=RECORDING_CHUNK_SCANS, queue_size=RECORDING_QUEUE_SIZE,
+                 backpressure=RECORDING_BACKPRESSURE):
+        assert backpressure in ("drop_oldest", "block")
         self.file = None
         self.is_recording = False
+        self.compression = compression
+        self.compression_level = compression_level if compression == "gzip" else None
+        self.chunk_scans = chunk_scans
+        self.backpressure = backpressure
+        self.num_scans = 0
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.feeder = None
+        self.waiting = 0
+        self.waiting_lock = threading.Lock()
+        self.writer = None
+        self.stopping = threading.Event()
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
         os.makedirs(SONAR_FILEPATH, exist_ok=True)
 
     def start_recording(self):
+        if self.file is not None:
+            logger.warning("Previous sonar recording is still being closed!")
+            return
+
         # Open the HDF5 file for writing/appending
         # 'a' mode to append data if the file exists
         logger.info("Start recording sonar.")
         if os.path.exists(SONAR_FILEPATH):
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.filename = f"sonar_data_{timestamp}_%03d.h5"
+            self.filename = f"sonar_data_{timestamp}.h5"
             self.filepath = os.path.join(SONAR_FILEPATH, self.filename)
             self.file = h5py.File(self.filepath, 'a')
+            self.file.attrs["format_version"] = RECORDING_FORMAT_VERSION
+            self.num_scans = len(self.file["scans"]) if "scans" in self.file else 0
+            self.queued = self.written = self.dropped = 0
+
+            # From here on only the writer thread touches the file
+            self.stopping.clear()
+            self.feeder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sonar-recorder-feeder")
+            self.writer = threading.Thread(target=self._write_loop, name="sonar-recorder", daemon=True)
+            self.writer.start()
             self.is_recording = True
 
     def stop_recording(self):
-        # Close the file when done
+        # Close the file when done, after the writer has drained the queue
         logger.info("Stop recording sonar.")
         if self.file:
-            self.file.close()
-            self.file = None
             self.is_recording = False
+            # Scans still waiting for room go into the queue before the writer drains it
+            self.feeder.shutdown(wait=True)
+            self.feeder = None
+            self.stopping.set()
+            self.writer.join()
+            self.writer = None
+            self.file = None
+            logger.info(f"Recorded {self.num_scans} scans to {self.filepath}. {self.get_stats()}")
+
+    def get_stats(self):
+        return {
+            "recording": self.is_recording,
+            "queued": self.queued,
+            "pending": self.queue.qsize(),
+            "waiting": self.waiting,
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+    def save_scan(self, scan, angles=None, settings=None, timestamp=None):
+        """Queue one (range x beam) scan for the writer thread."""
+        if not self.is_recording:
+            return
+
+        if timestamp is None:
+            timestamp = time.time()
 
-    def save_scan(self, scan):
-        if self.is_recording:
-            timestamp = int(time.time())
-            # Save the scan under a group named by the timestamp
-            self.file.create_dataset(f'scan_{timestamp}', data=scan)
+        # The writer owns its copy, the caller may reuse its buffers
+        item = (np.array(scan), None if angles is None else np.array(angles, dtype=np.float32),
+                dict(settings or {}), timestamp)
+
+        if self.backpressure == "block":
+            self._put_or_wait(item)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                break
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+        self.queued += 1
+
+    def _put_or_wait(self, item):
+        with self.waiting_lock:
+            if not self.waiting:
+                try:
+                    self.queue.put_nowait(item)
+                    self.queued += 1
+                    return
+                except queue.Full:
+                    pass
+            if self.waiting >= self.queue.maxsize:
+                self.dropped += 1
+                return
+            # Wait for room on the feeder thread, behind any scan already waiting
+            self.waiting += 1
+        self.feeder.submit(self._put_waiting, item)
+
+    def _put_waiting(self, item):
+        self.queue.put(item)
+        with self.waiting_lock:
+            self.waiting -= 1
+            self.queued += 1
+
+    def _write_loop(self):
+        file = self.file
+        try:
+            while True:
+                try:
+                    batch = [self.queue.get(timeout=0.2)]
+                except queue.Empty:
+                    if self.stopping.is_set():
+                        break
+                    continue
+
+                # Write everything that is already waiting before flushing once
+                while len(batch) < self.chunk_scans:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                chunks_before = self.num_scans // self.chunk_scans
+                for item in batch:
+                    try:
+                        self._write_scan(file, *item)
+                        self.written += 1
+                    except Exception as e:
+                        logger.error(f"Failed to write sonar scan: {e}")
+                if self.num_scans // self.chunk_scans != chunks_before:
+                    file.flush()
+        finally:
+            file.close()
+
+    def _create_datasets(self, file, num_ranges, num_beams, dtype):
+        """Create the extendable datasets, chunked so every chunk holds chunk_scans whole scans."""
+        chunk = self.chunk_scans
+        options = {"compression": self.compression, "compression_opts": self.compression_level}
+        file.create_dataset("scans", shape=(0, num_ranges, num_beams), maxshape=(None, None, num_beams),
+                            chunks=(chunk, num_ranges, num_beams), dtype=dtype, **options)
+        file.create_dataset("angles", shape=(0, num_beams), maxshape=(None, num_beams),
+                            chunks=(chunk, num_beams), dtype=np.float32, **options)
+        file.create_dataset("timestamps", shape=(0,), maxshape=(None,),
+                            chunks=(chunk,), dtype=np.float64)
+        file.create_dataset("settings", shape=(0,), maxshape=(None,),
+                            chunks=(chunk,), dtype=SETTINGS_DTYPE)
+
+    def _write_scan(self, file, scan, angles, settings, timestamp):
+        """
+        Append one scan to the recording.
+
+        Scans with fewer range samples than the widest one so far are zero padded, the actual count is
+        kept in the settings dataset. The file is flushed every chunk_scans scans, so a crash loses at most
+        one chunk.
+        """
+        if "scans" not in file:
+            self._create_datasets(file, scan.shape[0], scan.shape[1], scan.dtype)
+
+        scans = file["scans"]
+        num_ranges, num_beams = scans.shape[1:]
+        if scan.shape[1] != num_beams:
+            logger.warning(f"Scan with {scan.shape[1]} beams does not match recording with {num_beams}, skipped.")
+            return
+
+        rows = scan.shape[0]
+        if rows > num_ranges:
+            scans.resize(rows, axis=1)
+            num_ranges = rows
+
+        index = self.num_scans
+        for name in ("scans", "angles", "timestamps", "settings"):
+            file[name].resize(index + 1, axis=0)
+
+        if rows == num_ranges:
+            scans[index] = scan
         else:
-            pass
+            padded = np.zeros((num_ranges, num_beams), dtype=scans.dtype)
+            padded[:rows] = scan
+            scans[index] = padded
+
+        if angles is not None:
+            file["angles"][index] = angles
+        file["timestamps"][index] = timestamp
+
+        row = np.zeros((), dtype=SETTINGS_DTYPE)
+        for field, value in settings.items():
+            if field in SETTINGS_DTYPE.names:
+                row[field] = value
+        row["num_ranges"] = rows
+        file["settings"][index] = row
+
+        self.num_scans += 1
@@ -0,0 +1,178 @@
+from typing import NamedTuple, Optional
+import asyncio
+import re
+import time
+
+import h5py
+import numpy as np
+from loguru import logger
+
+from .ScanRecorder import is_chunked_recording
+
+from settings import RECORDED_ANGLES, REPLAY_SPEED, REPLAY_LOOP
+
+
+class ReplayScan(NamedTuple):
+    index: int
+    timestamp: Optional[float]
+    scan: np.ndarray  # read-only (range x beam) view
+    angles: list
+    start_index: int
+    cleaned: bool  # False for old recordings that still hold the near-field samples
+    sample_period: Optional[int] = None  # None for old recordings, which use SAMPLE_PERIOD
+
+
+def _readonly_view(file, dataset):
+    """
+    Zero-copy read-only view of a dataset.
+
+    Contiguous, uncompressed datasets are memory-mapped straight from the file, anything else
+    returns None and has to be read through h5py.
+    """
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.chunks is not None or dataset.size == 0:
+        return None
+    return np.memmap(file.filename, mode='r', dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+
+
+class ScanReplay:
+    """
+    Lazy reader that replays a sonar recording scan by scan.
+
+    Scans are yielded as read-only views. Uncompressed data is memory-mapped. Chunked recordings
+    are read one HDF5 chunk at a time and the scans are views into that block. Replay is paced by
+    the recorded timestamps scaled by speed; a speed of None or 0 replays as fast as possible.
+    """
+
+    def __init__(self, filename, speed=REPLAY_SPEED, loop=REPLAY_LOOP):
+        self.filename = filename
+        self.speed = speed
+        self.loop = loop
+        self.file = None
+        self.position = 0
+
+        self.timestamps = None
+        self._block_start = None
+        self._block = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        self.file = h5py.File(self.filename, 'r')
+        self.chunked = is_chunked_recording(self.file)
+
+        if self.chunked:
+            self.scans = self.file["scans"]
+            self.timestamps = self.file["timestamps"][:]
+            self.settings = self.file["settings"][:]
+            self.angles = self.file["angles"][:]
+            self.block_size = self.scans.chunks[0] if self.scans.chunks else 1
+            self.memmap = _readonly_view(self.file, self.scans)
+        else:
+            self.names = [name for name, item in self.file.items() if isinstance(item, h5py.Dataset)]
+            self.timestamps = self._timestamps_from_names(self.names)
+            if self.timestamps is not None:
+                order = np.argsort(self.timestamps, kind="stable")
+                self.names = [self.names[i] for i in order]
+                self.timestamps = self.timestamps[order]
+
+        logger.info(f"Replaying {len(self)} scans from {self.filename}.")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self._block = None
+        self._block_start = None
+
+    def __len__(self):
+        return len(self.scans) if self.chunked else len(self.names)
+
+    @staticmethod
+    def _timestamps_from_names(names):
+        """Old recordings name their datasets scan_<unix time>."""
+        timestamps = []
+        for name in names:
+            match = re.fullmatch(r"scan_(\d+)", name)
+            if match is None:
+                return None
+            timestamps.append(float(match.group(1)))
+        return np.array(timestamps)
+
+    def seek(self, index):
+        """Move the replay position to a scan index."""
+        if not 0 <= index < len(self):
+            raise IndexError(f"Scan {index} out of range for {len(self)} scans")
+        self.position = index
+
+    def seek_time(self, timestamp):
+        """Move the replay position to the first scan at or after timestamp."""
+        if self.timestamps is None:
+            raise ValueError(f"{self.filename} has no scan timestamps")
+        self.seek(min(int(np.searchsorted(self.timestamps, timestamp)), len(self) - 1))
+
+    def read(self, index):
+        """Return a scan as a read-only view without copying it."""
+        if self.chunked:
+            if self.memmap is not None:
+                scan = self.memmap[index]
+            else:
+                block_index = index - index % self.block_size
+                if block_index != self._block_start:
+                    # One HDF5 read per chunk, the scans of the block are views into it
+                    self._block = self.scans[block_index:block_index + self.block_size]
+                    self._block.flags.writeable = False
+                    self._block_start = block_index
+                scan = self._block[index - block_index]
+
+            settings = self.settings[index]
+            return ReplayScan(index, float(self.timestamps[index]), scan[:settings["num_ranges"]],
+                              self.angles[index].tolist(), int(settings["start_index"]), True,
+                              int(settings["sample_period"]) or None)
+
+        dataset = self.file[self.names[index]]
+        scan = _readonly_view(self.file, dataset)
+        if scan is None:
+            scan = dataset[:]
+            scan.flags.writeable = False
+        timestamp = None if self.timestamps is None else float(self.timestamps[index])
+        return ReplayScan(index, timestamp, scan, list(RECORDED_ANGLES), 0, False)
+
+    def __iter__(self):
+        """Yield scans from the current position, wrapping around when looping, without pacing."""
+        while True:
+            while self.position < len(self):
+                index = self.position
+                self.position += 1
+                yield self.read(index)
+            if not self.loop or len(self) == 0:
+                return
+            self.position = 0
+
+    async def __aiter__(self):
+        """Yield scans paced by their recorded timestamps divided by speed."""
+        wall_start = None
+        first_timestamp = None
+        previous_index = None
+
+        for record in self:
+            if not self.speed:
+                # As fast as possible, but still let other tasks run
+                await asyncio.sleep(0)
+            elif record.timestamp is None:
+                await asyncio.sleep(1.0 / self.speed)
+            else:
+                if wall_start is None or record.index <= previous_index:
+                    # Start of the replay or wrapped around to the first scan
+                    wall_start = time.monotonic()
+                    first_timestamp = record.timestamp
+                delay = wall_start + (record.timestamp - first_timestamp) / self.speed - time.monotonic()
+                await asyncio.sleep(max(delay, 0.0))
+
+            previous_index = record.index
+            yield record
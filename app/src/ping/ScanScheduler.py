@@ -0,0 +1,78 @@
+from collections import Counter
+
+import numpy as np
+
+from settings import ADAPTIVE_COARSE_STEP, ADAPTIVE_REFINE_WIDTH, FORWARD_SECTOR, FORWARD_REVISITS
+
+
+def sector_steps(start, end):
+    """Steps (gradians) from start to end inclusive, wrapping through 0."""
+    return [(start + i) % 400 for i in range((end - start) % 400 + 1)]
+
+
+class AdaptiveScanScheduler:
+    """
+    Plans the steps of each sweep from the detections of the previous one.
+
+    Empty stretches of the sector are sampled every coarse_step gradians, bearings within refine_width
+    steps of a detection are swept one gradian at a time. The forward sector is always swept at full
+    resolution and is revisited forward_revisits extra times per sweep, spread evenly over the sweep.
+    """
+
+    def __init__(self, start, end, coarse_step=ADAPTIVE_COARSE_STEP, refine_width=ADAPTIVE_REFINE_WIDTH,
+                 forward_sector=FORWARD_SECTOR, forward_revisits=FORWARD_REVISITS):
+        self.steps = sector_steps(start, end)
+        self.coarse_step = max(int(coarse_step), 1)
+        self.refine_width = max(int(refine_width), 0)
+        self.forward_revisits = max(int(forward_revisits), 0)
+
+        self.columns = {step: column for column, step in enumerate(self.steps)}
+        forward = set(sector_steps(*forward_sector)) if forward_sector is not None else set()
+        self.forward = np.array([step in forward for step in self.steps], dtype=bool)
+
+        # Whether the last visit of each sector step found a return, starts fully refined
+        self.hits = np.ones(len(self.steps), dtype=bool)
+
+    def update(self, steps, detections):
+        """Record whether each visited step had a detection in the sweep that just finished."""
+        columns = [self.columns[step] for step in steps if step in self.columns]
+        self.hits[columns] = np.asarray(detections, dtype=bool)[:len(columns)]
+
+    def refined(self):
+        """Mask of sector steps to sweep at full resolution."""
+        refined = self.forward.copy()
+        for offset in range(-self.refine_width, self.refine_width + 1):
+            shifted = np.roll(self.hits, offset)
+            # np.roll wraps around, the sector ends are not neighbours unless it is the full circle
+            if len(self.steps) < 400:
+                if offset > 0:
+                    shifted[:offset] = False
+                elif offset < 0:
+                    shifted[offset:] = False
+            refined |= shifted
+        return refined
+
+    def plan(self):
+        """Steps of the next sweep, in sweep order."""
+        selected = self.refined()
+        selected[::self.coarse_step] = True
+        selected[-1] = True
+        plan = [step for step, keep in zip(self.steps, selected) if keep]
+
+        forward_steps = [step for step in plan if self.forward[self.columns[step]]]
+        if not self.forward_revisits or not forward_steps:
+            return plan
+
+        # Extra passes over the forward sector, spread evenly over the steps outside of it
+        outside = [i for i, step in enumerate(plan) if not self.forward[self.columns[step]]]
+        if not outside:
+            return plan
+        # With fewer outside steps than revisits some steps are followed by several passes
+        revisits_after = Counter(outside[max(int(len(outside) * (k + 1) / (self.forward_revisits + 1)) - 1, 0)]
+                                 for k in range(self.forward_revisits))
+
+        scheduled = []
+        for i, step in enumerate(plan):
+            scheduled.append(step)
+            scheduled.extend(forward_steps * revisits_after[i])
+        return scheduled
@@ -0,0 +1,60 @@
+"""
+OpenCV filters for (range x beam) polar sonar images, run ahead of CFAR to cut speckle false alarms.
+
+Gaussian blur and rectangular morphology are separable in OpenCV, so their cost grows with the kernel
+side rather than its area. Every filter keeps the image dtype and shape.
+"""
+import cv2
+import numpy as np
+
+FILTERS = ("none", "median", "gaussian", "opening")
+
+
+def _odd(ksize):
+    ksize = max(int(ksize), 1)
+    return ksize if ksize % 2 else ksize + 1
+
+
+def median(img, ksize=3):
+    """Median over a ksize x ksize window, ksize above 5 needs uint8 images."""
+    return cv2.medianBlur(img, _odd(ksize))
+
+
+def gaussian(img, ksize=5, sigma=0):
+    """Separable Gaussian blur, sigma 0 derives it from ksize."""
+    ksize = _odd(ksize)
+    return cv2.GaussianBlur(img, (ksize, ksize), sigma)
+
+
+def opening(img, range_ksize=3, beam_ksize=3):
+    """Grey opening with a range_ksize x beam_ksize rectangle, removing returns smaller than the rectangle."""
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(int(beam_ksize), 1), max(int(range_ksize), 1)))
+    return cv2.morphologyEx(img, cv2.MORPH_OPEN, kernel)
+
+
+def beam_speckle(img, length=3):
+    """
+    Per-beam speckle suppression: an opening along range only, so beams are never mixed.
+
+    Returns shorter than length samples in range are removed, extended targets keep their shape.
+    """
+    return opening(img, range_ksize=length, beam_ksize=1)
+
+
+def denoise(img, method="median", ksize=3, sigma=0, speckle=0):
+    """Apply one of FILTERS followed by per-beam speckle suppression when speckle > 1."""
+    if method not in FILTERS:
+        raise ValueError(f"Unknown denoise filter {method}, available: {list(FILTERS)}")
+
+    # OpenCV needs C-contiguous input, sweep buffers are Fortran ordered
+    img = np.ascontiguousarray(img)
+    if method == "median":
+        img = median(img, ksize)
+    elif method == "gaussian":
+        img = gaussian(img, ksize, sigma)
+    elif method == "opening":
+        img = opening(img, ksize, ksize)
+
+    if speckle > 1:
+        img = beam_speckle(img, speckle)
+    return img
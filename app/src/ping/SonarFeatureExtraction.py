@@ -1,116 +1,136 @@
+import asyncio
+from collections import OrderedDict
+import time
 import numpy as np
 import cv2
 from scipy.interpolate import interp1d
+from .AdaptiveThresholding import AdaptiveThresholding
 from .CFAR import CFAR  # Your CFAR implementation
+from .SonarGeometry import SonarGeometry
+from .SonarPipeline import SonarPipeline
 from loguru import logger
 
+from settings import GEOMETRY_CACHE_SIZE
+
 
 class SonarFeatureExtraction:
-    def __init__(self, Ntc=40, Ngc=10, Pfa=1e-2, rank=None, alg="GOCA", resolution=0.5, threshold=30):
+    def __init__(self, Ntc=40, Ngc=10, Pfa=1e-2, rank=None, alg="GOCA", resolution=None, threshold=30):
         self.Ntc = Ntc
         self.Ngc = Ngc
         self.Pfa = Pfa
         self.rank = rank
         self.alg = alg
         self.threshold = threshold
-        self.resolution = resolution
-        # Use your CFAR implementation
-        self.detector = CFAR(self.Ntc, self.Ngc, self.Pfa)
+        self.resolution = resolution  # Cartesian grid resolution, None keeps the range resolution
+        # Use your CFAR implementation, adaptive thresholding serves the "LOCAL" and "OTSU" algorithms
+        self.cfar = CFAR(self.Ntc, self.Ngc, self.Pfa, self.rank)
+        self.adaptive = AdaptiveThresholding(floor=self.threshold)
         self.map_x = None
         self.map_y = None
+        self.geometries = OrderedDict()
 
         self.cfar_polar = None
-
-    async def create_costmap_in_cartesian(self, sonar_data, bearings, range_resolution):
-        '''Create a mesh grid of zeros in Cartesian coordinates from sonar data in polar coordinates'''
-        _res = range_resolution
-        _height = len(sonar_data) * _res
-
-        if bearings[-1] < bearings[0]:
-            bearing_range = 360 - (bearings[0] - bearings[-1])
+        self.pipeline = SonarPipeline(self)
+
+        # Rolling state for per-beam (streaming) detection
+        self.stream_geometry = None
+        self.stream_costmap = None
+        self.stream_cells = None
+
+    @property
+    def detector(self):
+        '''Detector of the active algorithm'''
+        return self.get_detector(self.alg)
+
+    def get_detector(self, alg):
+        return self.adaptive if alg in AdaptiveThresholding.ALGORITHMS else self.cfar
+
+    def get_geometry(self, bearings, range_resolution, num_ranges):
+        '''Return the cached sector geometry, building it only when the sonar settings change'''
+        key = (tuple(bearings), range_resolution, num_ranges, self.resolution)
+        geometry = self.geometries.get(key)
+        if geometry is None:
+            geometry = SonarGeometry(bearings, range_resolution, num_ranges, self.resolution)
+            self.geometries[key] = geometry
+            while len(self.geometries) > GEOMETRY_CACHE_SIZE:
+                self.geometries.popitem(last=False)
         else:
-            bearing_range = bearings[-1] - bearings[0]
-        _width = np.sin(np.radians(bearing_range)) * _height
-
-        # Create a meshgrid for x and y axes based on the range values
-        x_range = np.arange(-_width/2, _width/2, _res)
-        y_range = np.arange(0, _height, _res)
+            self.geometries.move_to_end(key)
 
-        X, Y = np.meshgrid(x_range, y_range)
+        return geometry
 
-        costmap = np.zeros_like(X, dtype=np.float32)
+    async def create_costmap_in_cartesian(self, sonar_data, bearings, range_resolution):
+        '''Create a mesh grid of zeros in Cartesian coordinates from sonar data in polar coordinates'''
+        geometry = self.get_geometry(bearings, range_resolution, len(sonar_data))
+        return geometry.empty_costmap(), geometry.x_range, geometry.y_range
 
-        return costmap, X, Y
+    async def warp_to_cartesian(self, sonar_data, bearings, range_resolution):
+        '''Resample the full polar intensity image onto the Cartesian costmap grid'''
+        geometry = self.get_geometry(bearings, range_resolution, len(sonar_data))
+        return geometry.warp(sonar_data), geometry.x_range, geometry.y_range
 
     async def extract_features(self, sonar_data, bearings, range_resolution):
-        '''Process sonar data and extract features using CFAR'''
-        img = sonar_data
-
-        # CFAR Detection
-        peaks = self.detector.detect(img, self.alg)
-        # peaks &= img > self.threshold  # Apply additional thresholding if necessary
-
-        self.cfar_polar = peaks
-
-        # Get indices of detected peaks
-        peak_indices = np.argwhere(peaks)
-
-        # Convert directly to Cartesian coordinates without using remap
-        points = []
-
-        # Handle bearings that wrap around 0/360
-        if bearings[0] > bearings[-1]:
-            # Adjust bearings that cross the 0/360 boundary
-            adjusted_bearings = bearings.copy()
-            for adjusted_bearing in adjusted_bearings:
-                if adjusted_bearing < 180:
-                    adjusted_bearing += 360
-        else:
-            adjusted_bearings = bearings
-
-        # For each peak, calculate its Cartesian coordinates
-        for peak in peak_indices:
-            range_idx, azimuth_idx = peak
-
-            # Get the range in meters
-            range_m = range_idx * range_resolution
-
-            # Get the bearing angle in radians
-            bearing_deg = adjusted_bearings[azimuth_idx % len(bearings)]
-            if bearing_deg > 360:
-                bearing_deg -= 360
-            bearing_rad = np.radians(bearing_deg)
-
-            # Convert to Cartesian
-            # Note: Using convention where 0 degrees = positive y-axis
-            y = range_m * np.cos(bearing_rad)
-            x = range_m * np.sin(bearing_rad)
-
-            points.append([y, x])
-
-        if not points:
-            return np.empty((0, 2))
+        '''Run the configured processing pipeline (by default CFAR, projection and rasterization) on a sweep'''
+        ctx = self.pipeline.run(sonar_data, bearings, range_resolution)
+        self.cfar_polar = ctx.mask
 
-        costmap, X, Y = await self.create_costmap_in_cartesian(
-            sonar_data, bearings, range_resolution)
-
-        for point in points:
-            # Convert polar (r, theta) to Cartesian (x, y)
-            x = point[1]  # X-coordinate in meters
-            y = point[0]  # Y-coordinate in meters
-
-            # Find the closest indices on the mesh grid
-            x_idx = np.abs(X[0] - x).argmin()  # Find closest X index
-            y_idx = np.abs(Y[:, 0] - y).argmin()  # Find closest Y index
-
-            # Mark the detected point on the costmap
-            costmap[y_idx, x_idx] = 1  # Or increment based on detection count
-
-        return costmap, X, Y
+        if ctx.costmap is None:
+            geometry = self.get_geometry(bearings, range_resolution, len(ctx.image))
+            return geometry.empty_costmap(), geometry.x_range, geometry.y_range
+        return ctx.costmap, ctx.geometry.x_range, ctx.geometry.y_range
 
     def get_cfar(self):
         return self.cfar_polar
 
+    def start_stream(self, bearings, num_ranges, range_resolution):
+        '''Reset the rolling polar mask and costmap for a sector swept one beam at a time'''
+        self.stream_geometry = self.get_geometry(bearings, range_resolution, num_ranges)
+        self.cfar_polar = np.zeros((num_ranges, len(bearings)), dtype=np.uint8)
+        self.stream_costmap = self.stream_geometry.empty_costmap()
+        self.stream_cells = [None] * len(bearings)
+
+    def stream_matches(self, bearings, num_ranges, range_resolution):
+        geometry = self.stream_geometry
+        return (geometry is not None
+                and self.cfar_polar is not None
+                and self.cfar_polar.shape == (num_ranges, len(bearings))
+                and geometry.range_resolution == range_resolution
+                and geometry.resolution == (range_resolution if self.resolution is None else self.resolution)
+                and geometry.bearings == tuple(bearings))
+
+    def update_beam(self, col, beam, range_resolution):
+        '''
+        Run CFAR on a single beam and fold its detections into the rolling mask and costmap.
+
+        CFAR only slides along range, so a beam gives the same mask as its column in a full sweep.
+        The hits the previous pass of this beam added to the costmap are retracted first.
+        '''
+        started = time.perf_counter()
+        peaks = self.detector.detect(beam[:, np.newaxis], self.alg)[:, 0]
+        self.cfar_polar[:, col] = peaks
+
+        old_cells = self.stream_cells[col]
+        if old_cells is not None:
+            np.subtract.at(self.stream_costmap, old_cells, 1)
+
+        range_idx = np.flatnonzero(peaks)
+        if range_idx.size == 0 or self.stream_costmap.size == 0:
+            self.stream_cells[col] = None
+            self.pipeline.record("stream", time.perf_counter() - started, 0)
+            return peaks
+
+        geometry = self.stream_geometry
+        cells = geometry.grid_indices(range_idx * range_resolution,
+                                      geometry.sin_table[col], geometry.cos_table[col])
+        np.add.at(self.stream_costmap, cells, 1)
+        self.stream_cells[col] = cells
+        self.pipeline.record("stream", time.perf_counter() - started, int(range_idx.size))
+
+        return peaks
+
+    def get_stream_costmap(self):
+        return self.stream_costmap, self.stream_geometry.x_range, self.stream_geometry.y_range
+
     async def update_cfar_parameters(self, Ntc, Ngc, Pfa, rank=None, alg=None, threshold=None):
         """
         Update CFAR parameters without recreating the detector.
@@ -136,8 +156,17 @@ class SonarFeatureExtraction:
 
         if threshold is not None:
             self.threshold = threshold
+            self.adaptive.floor = threshold
 
-        # Update the CFAR detector
-        self.detector = CFAR(self.Ntc, self.Ngc, self.Pfa, self.rank)
+        # Update the CFAR detector, solving for the threshold factor off the event loop
+        self.cfar = await asyncio.to_thread(self.create_detector)
 
         return True
+
+    def create_detector(self):
+        """Build a CFAR detector and make sure the factor for the active algorithm is cached."""
+        detector = CFAR(self.Ntc, self.Ngc, self.Pfa, self.rank)
+        if self.alg in detector.detector:
+            detector.threshold_factor(self.alg)
+            detector.cache.save()
+        return detector
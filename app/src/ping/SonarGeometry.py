@@ -0,0 +1,106 @@
+import numpy as np
+import cv2
+
+# Grid rows resampled per block while building the remap tables, bounds the temporaries
+REMAP_BLOCK_ROWS = 256
+
+
+class SonarGeometry:
+    """
+    Cartesian grid and polar-to-Cartesian lookup tables of one sonar sector.
+
+    Everything here depends only on the bearings, the range resolution, the number of range
+    samples and the output grid resolution, so one instance can be shared by every scan taken
+    with the same settings. Uses the convention where 0 degrees is the positive y-axis.
+
+    Only the 1-D grid axes are kept, cell (i, j) lies at (x_range[j], y_range[i]). The remap tables are
+    stored in the fixed-point format of cv2.convertMaps, 6 bytes per cell.
+    """
+
+    def __init__(self, bearings, range_resolution, num_ranges, resolution=None):
+        self.bearings = tuple(bearings)
+        self.range_resolution = range_resolution
+        self.num_ranges = num_ranges
+        self.resolution = range_resolution if resolution is None else resolution
+
+        max_range = num_ranges * range_resolution
+
+        bearing_rad = np.radians(np.asarray(self.bearings, dtype=np.float64))
+        self.sin_table = np.sin(bearing_rad)
+        self.cos_table = np.cos(bearing_rad)
+
+        # Grid axes of the costmap, spanning the sonar and the far end of every beam, so sectors
+        # of 180 degrees and more (or behind the sonar) get a grid too
+        x_ends = max_range * self.sin_table
+        y_ends = max_range * self.cos_table
+        self.x_range = np.arange(min(x_ends.min(), 0.0), max(x_ends.max(), 0.0), self.resolution)
+        self.y_range = np.arange(min(y_ends.min(), 0.0), max(y_ends.max(), 0.0), self.resolution)
+        self.x_range.flags.writeable = False
+        self.y_range.flags.writeable = False
+
+        self.map1, self.map2 = self._remap_tables()
+
+    @property
+    def shape(self):
+        return len(self.y_range), len(self.x_range)
+
+    @property
+    def size(self):
+        return len(self.y_range) * len(self.x_range)
+
+    def _remap_tables(self):
+        """Polar (column, row) source coordinates of every Cartesian cell, as fixed-point cv2.remap maps."""
+        rows, cols = self.shape
+        map1 = np.empty((rows, cols, 2), dtype=np.int16)
+        map2 = np.empty((rows, cols), dtype=np.uint16)
+        if map2.size == 0:
+            return map1, map2
+
+        # Bearings relative to the first beam so sectors across 0/360 stay monotonic
+        rel_bearings = (np.asarray(self.bearings, dtype=np.float64) - self.bearings[0]) % 360
+        order = np.argsort(rel_bearings)
+        beam_idx = order.astype(np.float64)
+        X = self.x_range.astype(np.float32)[np.newaxis, :]
+
+        for start in range(0, rows, REMAP_BLOCK_ROWS):
+            Y = self.y_range[start:start + REMAP_BLOCK_ROWS].astype(np.float32)[:, np.newaxis]
+            rel_theta = (np.degrees(np.arctan2(X, Y)) - self.bearings[0]) % 360
+
+            map_x = np.interp(rel_theta, rel_bearings[order], beam_idx, left=-1, right=-1).astype(np.float32)
+            map_y = np.hypot(X, Y) / np.float32(self.range_resolution)
+
+            # Cells outside the swept sector or past the last sample read the zero border
+            outside = (map_x < 0) | (map_y > self.num_ranges - 1)
+            map_x[outside] = -1
+            map_y[outside] = -1
+
+            block = slice(start, start + len(Y))
+            map1[block], map2[block] = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+
+        return map1, map2
+
+    def empty_costmap(self):
+        return np.zeros(self.shape, dtype=np.float32)
+
+    def grid_indices(self, range_m, sin_b, cos_b):
+        """
+        Map polar points onto the nearest costmap cell.
+
+        The grid axes are uniform, so the nearest cell comes from quantization instead of a search.
+        """
+        x = range_m * sin_b
+        y = range_m * cos_b
+
+        x_idx = np.clip(np.rint((x - self.x_range[0]) / self.resolution),
+                        0, len(self.x_range) - 1).astype(np.intp)
+        y_idx = np.clip(np.rint((y - self.y_range[0]) / self.resolution),
+                        0, len(self.y_range) - 1).astype(np.intp)
+
+        return y_idx, x_idx
+
+    def warp(self, img, interpolation=cv2.INTER_LINEAR):
+        """Resample a (range x beam) polar image onto the Cartesian grid in one remap call."""
+        if self.size == 0:
+            return np.zeros(self.shape, dtype=img.dtype)
+        return cv2.remap(img, self.map1, self.map2, interpolation,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=0)
@@ -0,0 +1,272 @@
+import bisect
+import numbers
+import time
+
+import cv2
+import numpy as np
+from loguru import logger
+
+from . import SonarDenoise
+from .BeamCleaner import BeamCleaner
+
+from settings import PIPELINE_STAGES, DENOISE_METHOD, DENOISE_KSIZE, DENOISE_SPECKLE
+
+# Upper bucket edges of the stage latency histograms, in milliseconds
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+LATENCY_BUCKET_LABELS = [f"<={edge}" for edge in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}"]
+
+
+class StageStats:
+    """Latency histogram and item count of one pipeline stage."""
+
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, seconds, items):
+        self.calls += 1
+        self.items += items
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1e3)] += 1
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "items": self.items,
+            "mean_ms": round(self.total / self.calls * 1e3, 3) if self.calls else 0.0,
+            "max_ms": round(self.max * 1e3, 3),
+            "histogram_ms": dict(zip(LATENCY_BUCKET_LABELS, self.histogram)),
+        }
+
+
+class SweepContext:
+    """What the stages of one pipeline run read and produce."""
+
+    def __init__(self, image, bearings, resolution, start_index=0, cleaned=True):
+        self.image = image  # (range x beam) intensities
+        self.bearings = bearings
+        self.resolution = resolution
+        self.start_index = start_index
+        self.cleaned = cleaned  # near-field samples already dropped
+        self.geometry = None
+        self.mask = None  # (range x beam) detections
+        self.clusters = None  # centroids (range, beam) of the kept clusters
+        self.cells = None  # costmap (row, col) of every detection
+        self.costmap = None
+
+
+class Stage:
+    """A pipeline step. Subclasses set the context fields they need and provide, and return an item count."""
+
+    name = None
+    requires = ()
+    provides = ()
+    defaults = {}
+
+    def __init__(self, extractor, **params):
+        unknown = set(params) - set(self.defaults)
+        if unknown:
+            raise ValueError(f"Unknown parameters for stage {self.name}: {sorted(unknown)}")
+        self.extractor = extractor
+        self.params = {**self.defaults, **params}
+
+    def __call__(self, ctx):
+        raise NotImplementedError
+
+
+class DenoiseStage(Stage):
+    """OpenCV median, Gaussian or opening filter on the polar image, then per-beam speckle suppression."""
+
+    name = "denoise"
+    requires = ("image",)
+    provides = ("image",)
+    defaults = {"method": DENOISE_METHOD, "ksize": DENOISE_KSIZE, "sigma": 0, "speckle": DENOISE_SPECKLE}
+
+    def __init__(self, extractor, **params):
+        super().__init__(extractor, **params)
+        if self.params["method"] not in SonarDenoise.FILTERS:
+            raise ValueError(f"Unknown denoise filter {self.params['method']}, available: {list(SonarDenoise.FILTERS)}")
+
+    def __call__(self, ctx):
+        ctx.image = SonarDenoise.denoise(ctx.image, **self.params)
+        return ctx.image.shape[1]
+
+
+class CleanStage(Stage):
+    """Near-field cutoff, TVG and amplitude threshold for images that were not cleaned beam by beam."""
+
+    name = "clean"
+    requires = ("image",)
+    provides = ("image",)
+    defaults = {"threshold": 0}
+
+    def __init__(self, extractor, **params):
+        super().__init__(extractor, **params)
+        threshold = self.params["threshold"]
+        if isinstance(threshold, bool) or not isinstance(threshold, numbers.Real) or not 0 <= threshold <= 255:
+            raise ValueError(f"Clean threshold must be a number from 0 to 255, got {threshold!r}")
+        self.cleaner = BeamCleaner()
+        self.threshold_only = BeamCleaner(blanking_distance=0, tvg_spreading=0, tvg_absorption=0)
+
+    def __call__(self, ctx):
+        if ctx.cleaned:
+            ctx.image, _ = self.threshold_only.clean(ctx.image, ctx.resolution, self.params["threshold"])
+        else:
+            ctx.image, ctx.start_index = self.cleaner.clean(ctx.image, ctx.resolution, self.params["threshold"])
+            ctx.cleaned = True
+        return ctx.image.shape[1]
+
+
+class CFARStage(Stage):
+    """Detection with CFAR or, for the "LOCAL" and "OTSU" algorithms, adaptive thresholding."""
+
+    name = "cfar"
+    requires = ("image",)
+    provides = ("mask",)
+    defaults = {"alg": None}  # None follows the extractor's algorithm
+
+    def __init__(self, extractor, **params):
+        super().__init__(extractor, **params)
+        alg = self.params["alg"]
+        if alg is not None and alg not in extractor.cfar.detector and alg not in extractor.adaptive.detector2:
+            raise ValueError(f"Unknown detection algorithm {alg}")
+
+    def __call__(self, ctx):
+        alg = self.params["alg"] or self.extractor.alg
+        ctx.mask = self.extractor.get_detector(alg).detect(ctx.image, alg)
+        return int(np.count_nonzero(ctx.mask))
+
+
+class ClusterStage(Stage):
+    """Connected components of the mask, dropping clusters smaller than min_size cells."""
+
+    name = "cluster"
+    requires = ("mask",)
+    provides = ("mask", "clusters")
+    defaults = {"min_size": 3, "connectivity": 8}
+
+    def __call__(self, ctx):
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(
+            np.ascontiguousarray(ctx.mask, dtype=np.uint8), connectivity=self.params["connectivity"])
+        keep = stats[:, cv2.CC_STAT_AREA] >= self.params["min_size"]
+        keep[0] = False  # background
+        ctx.mask = keep[labels].astype(np.uint8)
+        # centroids are (x, y) = (beam, range)
+        ctx.clusters = centroids[keep][:, ::-1]
+        return int(np.count_nonzero(keep))
+
+
+class ProjectStage(Stage):
+    """Costmap cells of every detection, all projected to Cartesian at once."""
+
+    name = "project"
+    requires = ("mask",)
+    provides = ("cells",)
+
+    def __call__(self, ctx):
+        geometry = self.extractor.get_geometry(ctx.bearings, ctx.resolution, len(ctx.image))
+        ctx.geometry = geometry
+        range_idx, azimuth_idx = np.nonzero(ctx.mask)
+        if range_idx.size == 0 or geometry.size == 0:
+            ctx.cells = (np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp))
+            return 0
+
+        ctx.cells = geometry.grid_indices(range_idx * geometry.range_resolution,
+                                          geometry.sin_table[azimuth_idx], geometry.cos_table[azimuth_idx])
+        return int(range_idx.size)
+
+
+class RasterizeStage(Stage):
+    """Count of detections per costmap cell."""
+
+    name = "rasterize"
+    requires = ("cells",)
+    provides = ("costmap",)
+
+    def __call__(self, ctx):
+        ctx.costmap = ctx.geometry.empty_costmap()
+        np.add.at(ctx.costmap, ctx.cells, 1)
+        return int(np.count_nonzero(ctx.costmap))
+
+
+STAGES = {stage.name: stage for stage in (DenoiseStage, CleanStage, CFARStage, ClusterStage, ProjectStage,
+                                          RasterizeStage)}
+
+# Stages the per-beam streaming path of PingManager reproduces exactly
+STREAMING_STAGES = ["cfar", "project", "rasterize"]
+
+
+class SonarPipeline:
+    """
+    Configurable chain of sweep processing stages with per-stage latency histograms and item counts.
+
+    The stages run in the configured order on a SweepContext. A configuration is rejected when a stage
+    needs something no earlier stage provides.
+    """
+
+    def __init__(self, extractor, stages=None, params=None):
+        self.extractor = extractor
+        self.stages = []
+        self.stats = {}
+        self.configure(PIPELINE_STAGES if stages is None else stages, params)
+
+    def configure(self, stages, params=None):
+        params = params or {}
+        unknown = [name for name in list(stages) + list(params) if name not in STAGES]
+        if unknown:
+            raise ValueError(f"Unknown pipeline stages: {unknown}, available: {list(STAGES)}")
+
+        available = {"image"}
+        built = []
+        for name in stages:
+            stage = STAGES[name](self.extractor, **params.get(name, {}))
+            missing = [field for field in stage.requires if field not in available]
+            if missing:
+                raise ValueError(f"Stage {name} needs {missing} from an earlier stage")
+            available.update(stage.provides)
+            built.append(stage)
+
+        self.stages = built
+        self.stats = {stage.name: StageStats() for stage in built}
+        logger.info(f"Sonar pipeline: {' -> '.join(self.stage_names)}")
+
+    @property
+    def stage_names(self):
+        return [stage.name for stage in self.stages]
+
+    @property
+    def streamable(self):
+        """True when beam-by-beam streaming CFAR gives the same result as this pipeline."""
+        return (self.stage_names == STREAMING_STAGES
+                and all(not stage.params.get("alg") for stage in self.stages)
+                and self.extractor.detector.is_range_only(self.extractor.alg))
+
+    def run(self, image, bearings, resolution, start_index=0, cleaned=True):
+        ctx = SweepContext(image, bearings, resolution, start_index, cleaned)
+        for stage in self.stages:
+            started = time.perf_counter()
+            items = stage(ctx)
+            self.record(stage.name, time.perf_counter() - started, items)
+        return ctx
+
+    def record(self, name, seconds, items):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = StageStats()
+        stats.record(seconds, items)
+
+    def reset_stats(self):
+        self.stats = {name: StageStats() for name in self.stats}
+
+    def get_config(self):
+        return {
+            "stages": [{"name": stage.name, "params": stage.params} for stage in self.stages],
+            "available": list(STAGES),
+        }
+
+    def get_stats(self):
+        return {name: stats.to_dict() for name, stats in self.stats.items()}
@@ -0,0 +1,84 @@
+import numpy as np
+from loguru import logger
+
+
+class SweepBuffer:
+    """
+    Preallocated, double-buffered (range x beam) matrix for a sector swept one beam at a time.
+
+    Beams are written in place into the back buffer at their bearing's column. swap() turns the back
+    buffer into the completed sweep, filling the columns that were not written this sweep from the
+    previous one, so front always holds the latest full sweep. Both buffers are Fortran ordered so a
+    beam is one contiguous column.
+
+    front is handed out without copying and stays valid until the following swap.
+    """
+
+    def __init__(self, bearings, num_ranges=None, dtype=np.uint8):
+        self.bearings = np.asarray(bearings, dtype=np.float64)
+        self.dtype = dtype
+        self.num_ranges = None
+        self.front = None
+        self.back = None
+        self.front_angles = self.bearings.copy()
+        self.back_angles = self.bearings.copy()
+        self.written = np.zeros(len(self.bearings), dtype=bool)
+        if num_ranges is not None:
+            self.reset(num_ranges)
+
+    @property
+    def num_beams(self):
+        return len(self.bearings)
+
+    def reset(self, num_ranges):
+        """(Re)allocate both buffers for beams of num_ranges samples, forgetting every sweep."""
+        shape = (num_ranges, self.num_beams)
+        self.num_ranges = num_ranges
+        self._buffers = [np.zeros(shape, dtype=self.dtype, order='F'), np.zeros(shape, dtype=self.dtype, order='F')]
+        self.back, front = self._buffers
+        self.front = front.view()
+        self.front.flags.writeable = False
+        self.front_angles[:] = self.bearings
+        self.back_angles[:] = self.bearings
+        self.written[:] = False
+
+    def column(self, column, num_ranges, angle=None):
+        """Claim a column of the sweep in progress for a beam of num_ranges samples, returns its view."""
+        if self.back is None or num_ranges != self.num_ranges:
+            if self.back is not None:
+                logger.debug(f"Beam length changed from {self.num_ranges} to {num_ranges}, reallocating sweep buffer.")
+            self.reset(num_ranges)
+
+        self.back_angles[column] = self.bearings[column] if angle is None else angle
+        self.written[column] = True
+        return self.back[:, column]
+
+    def write(self, column, beam, angle=None):
+        """Copy a beam into its column of the sweep in progress, returns the column view."""
+        target = self.column(column, len(beam), angle)
+        np.copyto(target, beam, casting='unsafe')
+        return target
+
+    @property
+    def beams_written(self):
+        return int(np.count_nonzero(self.written))
+
+    def swap(self):
+        """Complete the sweep in progress and return it as the read-only front buffer."""
+        if self.back is None:
+            return None
+
+        back, front = self._buffers
+        # Bearings skipped this sweep keep the beam from the previous one, copied column by column
+        # so no temporary matrix is allocated
+        for column in np.flatnonzero(~self.written):
+            back[:, column] = front[:, column]
+            self.back_angles[column] = self.front_angles[column]
+
+        self._buffers = [front, back]
+        self.back = front
+        self.front = back.view()
+        self.front.flags.writeable = False
+        self.front_angles, self.back_angles = self.back_angles, self.front_angles
+        self.written[:] = False
+        return self.front
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+import json
+import os
+import threading
+
+from loguru import logger
+
+from settings import CFAR_CACHE_SIZE, CFAR_CACHE_FILEPATH
+
+
+class ThresholdFactorCache:
+    """
+    Bounded LRU cache of CFAR threshold factors.
+
+    Keys are (alg, Ntc, Pfa, rank) tuples; rank is None for every algorithm
+    except OS, and the guard cell count is left out since it does not change
+    the factor. Entries can be saved to and loaded from a JSON file so root
+    searches survive restarts.
+    """
+
+    def __init__(self, max_size=CFAR_CACHE_SIZE, filepath=CFAR_CACHE_FILEPATH):
+        self.max_size = max_size
+        self.filepath = filepath
+        self.factors = OrderedDict()
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.factors)
+
+    def __contains__(self, key: Hashable):
+        with self.lock:
+            return key in self.factors
+
+    def get(self, key: Hashable, compute: Callable[[], float]) -> float:
+        """Return the cached factor for key, computing and storing it on a miss."""
+        with self.lock:
+            if key in self.factors:
+                self.factors.move_to_end(key)
+                return self.factors[key]
+
+        # Root finding runs outside the lock, a concurrent miss just computes twice
+        value = float(compute())
+        self.put(key, value)
+        return value
+
+    def put(self, key: Hashable, value: float):
+        with self.lock:
+            self.factors[key] = value
+            self.factors.move_to_end(key)
+            while len(self.factors) > self.max_size:
+                self.factors.popitem(last=False)
+            self.dirty = True
+
+    def clear(self):
+        with self.lock:
+            self.factors.clear()
+            self.dirty = True
+
+    def save(self, filepath: Optional[str] = None):
+        """Write the cache to disk if it changed since the last save or load."""
+        filepath = filepath or self.filepath
+        with self.lock:
+            if not self.dirty:
+                return
+            entries = [list(key) + [value] for key, value in self.factors.items()]
+            self.dirty = False
+
+        try:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            tmp_filepath = f"{filepath}.tmp"
+            with open(tmp_filepath, 'w') as file:
+                json.dump(entries, file)
+            os.replace(tmp_filepath, filepath)
+            logger.info(f"Saved {len(entries)} CFAR threshold factors to {filepath}.")
+        except OSError as e:
+            logger.error(f"Could not save CFAR threshold factors: {e}")
+
+    def load(self, filepath: Optional[str] = None):
+        filepath = filepath or self.filepath
+        if not os.path.exists(filepath):
+            return
+
+        try:
+            with open(filepath, 'r') as file:
+                entries = json.load(file)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load CFAR threshold factors: {e}")
+            return
+
+        with self.lock:
+            for alg, Ntc, Pfa, rank, value in entries:
+                self.factors[(alg, Ntc, Pfa, rank)] = value
+                self.factors.move_to_end((alg, Ntc, Pfa, rank))
+            while len(self.factors) > self.max_size:
+                self.factors.popitem(last=False)
+            self.dirty = False
+        logger.info(f"Loaded {len(entries)} CFAR threshold factors from {filepath}.")
+
+
+threshold_cache = ThresholdFactorCache()
@@ -1,137 +1,213 @@
 import numpy as np
 
 
-def ca(img: np.ndarray, train_hs: int, guard_hs: int, tau: float) -> np.ndarray:
-    ret = np.zeros_like(img, dtype=np.uint8)
+def _training_sums(img: np.ndarray, train_hs: int, guard_hs: int):
+    """
+    Leading and lagging training-cell sums for every cell the 1-D kernels evaluate.
 
-    for col in range(img.shape[1]):
-        for row in range(train_hs + guard_hs, img.shape[0] - train_hs - guard_hs):
-            sum_train = 0
-            for i in range(row - train_hs - guard_hs, row + train_hs + guard_hs + 1):
-                if abs(i - row) > guard_hs:
-                    sum_train += img[i, col]
-            ret[row, col] = img[row, col] > tau * sum_train / (2.0 * train_hs)
+    Cells are evaluated on rows [train_hs + guard_hs, rows - train_hs - guard_hs)
+    of every column. Sums come from a float64 prefix sum along the range axis, so
+    they are exact for the integer-valued sonar intensities. For float32 input the
+    thresholds agree with a running sum only to within float rounding.
+    """
+    rows = img.shape[0]
+    half = train_hs + guard_hs
 
-    return ret
+    csum = np.zeros((rows + 1,) + img.shape[1:], dtype=np.float64)
+    np.cumsum(img, axis=0, dtype=np.float64, out=csum[1:])
 
+    # leading cells: [row - half, row - guard_hs), lagging: (row + guard_hs, row + half]
+    leading = csum[train_hs:rows - half - guard_hs] - csum[:rows - 2 * half]
+    lagging = csum[2 * half + 1:] - csum[half + guard_hs + 1:rows - train_hs + 1]
 
-def soca(img: np.ndarray, train_hs: int, guard_hs: int, tau: float) -> np.ndarray:
-    ret = np.zeros_like(img, dtype=np.uint8)
+    return leading, lagging
 
-    for col in range(img.shape[1]):
-        for row in range(train_hs + guard_hs, img.shape[0] - train_hs - guard_hs):
-            leading_sum, lagging_sum = 0.0, 0.0
-            for i in range(row - train_hs - guard_hs, row + train_hs + guard_hs + 1):
-                if (i - row) > guard_hs:
-                    lagging_sum += img[i, col]
-                elif (i - row) < -guard_hs:
-                    leading_sum += img[i, col]
-            sum_train = min(leading_sum, lagging_sum)
-            ret[row, col] = img[row, col] > tau * sum_train / train_hs
 
-    return ret
+def _kth_training_value(img: np.ndarray, train_hs: int, guard_hs: int, k: int,
+                       block_cols: int = 64) -> np.ndarray:
+    """
+    k-th smallest training cell of every cell the 1-D kernels evaluate.
 
+    The training cells of each column are taken from a strided window view along
+    range and partitioned all at once, a block of columns at a time so the
+    gathered training cells stay small for wide scans.
+    """
+    half = train_hs + guard_hs
+    windows = np.lib.stride_tricks.sliding_window_view(img, 2 * half + 1, axis=0)
+    kth = np.empty(windows.shape[:-1], dtype=img.dtype)
 
-def goca(img: np.ndarray, train_hs: int, guard_hs: int, tau: float) -> np.ndarray:
+    for start in range(0, img.shape[1], block_cols):
+        block = windows[:, start:start + block_cols]
+        train = np.concatenate(
+            (block[..., :train_hs], block[..., train_hs + 2 * guard_hs + 1:]), axis=-1)
+        train.partition(k, axis=-1)
+        kth[:, start:start + block_cols] = train[..., k]
+
+    return kth
+
+
+def _detect(img: np.ndarray, train_hs: int, guard_hs: int, threshold: np.ndarray):
+    """Compare interior cells against their threshold and build the mask and threshold images."""
     ret = np.zeros_like(img, dtype=np.uint8)
+    ret2 = np.zeros_like(img, dtype=np.float32)
 
-    for col in range(img.shape[1]):
-        for row in range(train_hs + guard_hs, img.shape[0] - train_hs - guard_hs):
-            leading_sum, lagging_sum = 0.0, 0.0
-            for i in range(row - train_hs - guard_hs, row + train_hs + guard_hs + 1):
-                if (i - row) > guard_hs:
-                    lagging_sum += img[i, col]
-                elif (i - row) < -guard_hs:
-                    leading_sum += img[i, col]
-            sum_train = max(leading_sum, lagging_sum)
-            ret[row, col] = img[row, col] > tau * sum_train / train_hs
+    half = train_hs + guard_hs
+    interior = slice(half, img.shape[0] - half)
+    ret[interior] = img[interior] > threshold
+    ret2[interior] = threshold
 
-    return ret
+    return ret, ret2
 
 
-def os(img: np.ndarray, train_hs: int, guard_hs: int, k: int, tau: float) -> np.ndarray:
-    ret = np.zeros_like(img, dtype=np.uint8)
+def _ca_threshold(img, train_hs, guard_hs, tau):
+    leading, lagging = _training_sums(img, train_hs, guard_hs)
+    return tau * (leading + lagging) / (2.0 * train_hs)
 
-    for col in range(img.shape[1]):
-        for row in range(train_hs + guard_hs, img.shape[0] - train_hs - guard_hs):
-            train = []
-            for i in range(row - train_hs - guard_hs, row + train_hs + guard_hs + 1):
-                if abs(i - row) > guard_hs:
-                    train.append(img[i, col])
-            train = np.array(train)
-            kth_value = np.partition(train, k)[k]
-            ret[row, col] = img[row, col] > tau * kth_value
 
-    return ret
+def _soca_threshold(img, train_hs, guard_hs, tau):
+    leading, lagging = _training_sums(img, train_hs, guard_hs)
+    return tau * np.minimum(leading, lagging) / train_hs
 
 
-def ca2(img: np.ndarray, train_hs: int, guard_hs: int, tau: float):
-    ret = np.zeros_like(img, dtype=np.uint8)
-    ret2 = np.zeros_like(img, dtype=np.float32)
+def _goca_threshold(img, train_hs, guard_hs, tau):
+    leading, lagging = _training_sums(img, train_hs, guard_hs)
+    return tau * np.maximum(leading, lagging) / train_hs
 
-    for col in range(img.shape[1]):
-        for row in range(train_hs + guard_hs, img.shape[0] - train_hs - guard_hs):
-            sum_train = 0
-            for i in range(row - train_hs - guard_hs, row + train_hs + guard_hs + 1):
-                if abs(i - row) > guard_hs:
-                    sum_train += img[i, col]
-            ret[row, col] = img[row, col] > tau * sum_train / (2.0 * train_hs)
-            ret2[row, col] = tau * sum_train / (2.0 * train_hs)
 
-    return ret, ret2
+def _os_threshold(img, train_hs, guard_hs, k, tau):
+    return tau * _kth_training_value(img, train_hs, guard_hs, int(k))
 
 
-def soca2(img: np.ndarray, train_hs: int, guard_hs: int, tau: float):
-    ret = np.zeros_like(img, dtype=np.uint8)
-    ret2 = np.zeros_like(img, dtype=np.float32)
+def ca(img: np.ndarray, train_hs: int, guard_hs: int, tau: float) -> np.ndarray:
+    if img.shape[0] <= 2 * (train_hs + guard_hs):
+        return np.zeros_like(img, dtype=np.uint8)
+    return _detect(img, train_hs, guard_hs, _ca_threshold(img, train_hs, guard_hs, tau))[0]
 
-    for col in range(img.shape[1]):
-        for row in range(train_hs + guard_hs, img.shape[0] - train_hs - guard_hs):
-            leading_sum, lagging_sum = 0.0, 0.0
-            for i in range(row - train_hs - guard_hs, row + train_hs + guard_hs + 1):
-                if (i - row) > guard_hs:
-                    lagging_sum += img[i, col]
-                elif (i - row) < -guard_hs:
-                    leading_sum += img[i, col]
-            sum_train = min(leading_sum, lagging_sum)
-            ret[row, col] = img[row, col] > tau * sum_train / train_hs
-            ret2[row, col] = tau * sum_train / train_hs
 
-    return ret, ret2
+def soca(img: np.ndarray, train_hs: int, guard_hs: int, tau: float) -> np.ndarray:
+    if img.shape[0] <= 2 * (train_hs + guard_hs):
+        return np.zeros_like(img, dtype=np.uint8)
+    return _detect(img, train_hs, guard_hs, _soca_threshold(img, train_hs, guard_hs, tau))[0]
 
 
-def goca2(img: np.ndarray, train_hs: int, guard_hs: int, tau: float):
-    ret = np.zeros_like(img, dtype=np.uint8)
-    ret2 = np.zeros_like(img, dtype=np.float32)
+def goca(img: np.ndarray, train_hs: int, guard_hs: int, tau: float) -> np.ndarray:
+    if img.shape[0] <= 2 * (train_hs + guard_hs):
+        return np.zeros_like(img, dtype=np.uint8)
+    return _detect(img, train_hs, guard_hs, _goca_threshold(img, train_hs, guard_hs, tau))[0]
 
-    for col in range(img.shape[1]):
-        for row in range(train_hs + guard_hs, img.shape[0] - train_hs - guard_hs):
-            leading_sum, lagging_sum = 0.0, 0.0
-            for i in range(row - train_hs - guard_hs, row + train_hs + guard_hs + 1):
-                if (i - row) > guard_hs:
-                    lagging_sum += img[i, col]
-                elif (i - row) < -guard_hs:
-                    leading_sum += img[i, col]
-            sum_train = max(leading_sum, lagging_sum)
-            ret[row, col] = img[row, col] > tau * sum_train / train_hs
-            ret2[row, col] = tau * sum_train / train_hs
 
-    return ret, ret2
+def os(img: np.ndarray, train_hs: int, guard_hs: int, k: int, tau: float) -> np.ndarray:
+    if img.shape[0] <= 2 * (train_hs + guard_hs):
+        return np.zeros_like(img, dtype=np.uint8)
+    return _detect(img, train_hs, guard_hs, _os_threshold(img, train_hs, guard_hs, k, tau))[0]
+
+
+def ca2(img: np.ndarray, train_hs: int, guard_hs: int, tau: float):
+    if img.shape[0] <= 2 * (train_hs + guard_hs):
+        return np.zeros_like(img, dtype=np.uint8), np.zeros_like(img, dtype=np.float32)
+    return _detect(img, train_hs, guard_hs, _ca_threshold(img, train_hs, guard_hs, tau))
+
+
+def soca2(img: np.ndarray, train_hs: int, guard_hs: int, tau: float):
+    if img.shape[0] <= 2 * (train_hs + guard_hs):
+        return np.zeros_like(img, dtype=np.uint8), np.zeros_like(img, dtype=np.float32)
+    return _detect(img, train_hs, guard_hs, _soca_threshold(img, train_hs, guard_hs, tau))
+
+
+def goca2(img: np.ndarray, train_hs: int, guard_hs: int, tau: float):
+    if img.shape[0] <= 2 * (train_hs + guard_hs):
+        return np.zeros_like(img, dtype=np.uint8), np.zeros_like(img, dtype=np.float32)
+    return _detect(img, train_hs, guard_hs, _goca_threshold(img, train_hs, guard_hs, tau))
 
 
 def os2(img: np.ndarray, train_hs: int, guard_hs: int, k: int, tau: float):
-    ret = np.zeros_like(img, dtype=np.uint8)
-    ret2 = np.zeros_like(img, dtype=np.float32)
+    if img.shape[0] <= 2 * (train_hs + guard_hs):
+        return np.zeros_like(img, dtype=np.uint8), np.zeros_like(img, dtype=np.float32)
+    return _detect(img, train_hs, guard_hs, _os_threshold(img, train_hs, guard_hs, k, tau))
 
-    for col in range(img.shape[1]):
-        for row in range(train_hs + guard_hs, img.shape[0] - train_hs - guard_hs):
-            train = []
-            for i in range(row - train_hs - guard_hs, row + train_hs + guard_hs + 1):
-                if abs(i - row) > guard_hs:
-                    train.append(img[i, col])
-            train = np.array(train)
-            kth_value = np.partition(train, k)[k]
-            ret[row, col] = img[row, col] > tau * kth_value
-            ret2[row, col] = tau * kth_value
 
-    return ret, ret2
+def _summed_area_table(img: np.ndarray, beam_half: int):
+    """
+    Float64 summed-area table of img, padded by beam_half reflected columns on both sides.
+
+    Any rectangle sum costs four lookups, so the 2-D kernels do not depend on the window size.
+    The bearing axis is padded instead of clipped so every cell sees the same number of
+    training cells and the threshold factor holds up to the sector edges.
+    """
+    padded = np.pad(img, ((0, 0), (beam_half, beam_half)), mode="reflect")
+    table = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(padded, axis=0, dtype=np.float64), axis=1, out=table[1:, 1:])
+    return table
+
+
+def _rect_sums(table, rows, cols, row_offset, col_offset, r0, r1, c0, c1):
+    """Sums over rows [i + r0, i + r1] and columns [j + c0, j + c1] of the padded image for every cell (i, j)."""
+    i0, j0 = row_offset, col_offset
+    bottom = slice(i0 + r1 + 1, i0 + r1 + 1 + rows)
+    top = slice(i0 + r0, i0 + r0 + rows)
+    right = slice(j0 + c1 + 1, j0 + c1 + 1 + cols)
+    left = slice(j0 + c0, j0 + c0 + cols)
+    return table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+
+
+def _training_sums_2d(img, train_hs, guard_hs, train_bs, guard_bs):
+    """
+    Leading (nearer in range) and lagging training sums of the range x bearing ring around every cell.
+
+    Cells are evaluated on the same interior rows as the 1-D kernels. The leading half is the ring above
+    the cell's row, the lagging half the ring below it; the cell's own row is left out so both halves
+    hold the same number of cells.
+    """
+    rows, cols = img.shape
+    half = train_hs + guard_hs
+    beam_half = train_bs + guard_bs
+    table = _summed_area_table(img, beam_half)
+    out_rows = rows - 2 * half
+
+    def ring(r0, r1, g0, g1):
+        outer = _rect_sums(table, out_rows, cols, half, beam_half, r0, r1, -beam_half, beam_half)
+        guard = _rect_sums(table, out_rows, cols, half, beam_half, g0, g1, -guard_bs, guard_bs)
+        return outer - guard
+
+    leading = ring(-half, -1, -guard_hs, -1)
+    lagging = ring(1, half, 1, guard_hs)
+    return leading, lagging
+
+
+def _training_cells_2d(train_hs, guard_hs, train_bs, guard_bs):
+    """Training cells in each half of the 2-D ring."""
+    return (train_hs + guard_hs) * (2 * (train_bs + guard_bs) + 1) - guard_hs * (2 * guard_bs + 1)
+
+
+def _ca_2d_threshold(img, train_hs, guard_hs, train_bs, guard_bs, tau):
+    leading, lagging = _training_sums_2d(img, train_hs, guard_hs, train_bs, guard_bs)
+    return tau * (leading + lagging) / (2.0 * _training_cells_2d(train_hs, guard_hs, train_bs, guard_bs))
+
+
+def _goca_2d_threshold(img, train_hs, guard_hs, train_bs, guard_bs, tau):
+    leading, lagging = _training_sums_2d(img, train_hs, guard_hs, train_bs, guard_bs)
+    return tau * np.maximum(leading, lagging) / _training_cells_2d(train_hs, guard_hs, train_bs, guard_bs)
+
+
+def ca_2d(img: np.ndarray, train_hs: int, guard_hs: int, train_bs: int, guard_bs: int, tau: float) -> np.ndarray:
+    if img.shape[0] <= 2 * (train_hs + guard_hs):
+        return np.zeros_like(img, dtype=np.uint8)
+    return _detect(img, train_hs, guard_hs, _ca_2d_threshold(img, train_hs, guard_hs, train_bs, guard_bs, tau))[0]
+
+
+def goca_2d(img: np.ndarray, train_hs: int, guard_hs: int, train_bs: int, guard_bs: int, tau: float) -> np.ndarray:
+    if img.shape[0] <= 2 * (train_hs + guard_hs):
+        return np.zeros_like(img, dtype=np.uint8)
+    return _detect(img, train_hs, guard_hs, _goca_2d_threshold(img, train_hs, guard_hs, train_bs, guard_bs, tau))[0]
+
+
+def ca_2d2(img: np.ndarray, train_hs: int, guard_hs: int, train_bs: int, guard_bs: int, tau: float):
+    if img.shape[0] <= 2 * (train_hs + guard_hs):
+        return np.zeros_like(img, dtype=np.uint8), np.zeros_like(img, dtype=np.float32)
+    return _detect(img, train_hs, guard_hs, _ca_2d_threshold(img, train_hs, guard_hs, train_bs, guard_bs, tau))
+
+
+def goca_2d2(img: np.ndarray, train_hs: int, guard_hs: int, train_bs: int, guard_bs: int, tau: float):
+    if img.shape[0] <= 2 * (train_hs + guard_hs):
+        return np.zeros_like(img, dtype=np.uint8), np.zeros_like(img, dtype=np.float32)
+    return _detect(img, train_hs, guard_hs, _goca_2d_threshold(img, train_hs, guard_hs, train_bs, guard_bs, tau))
@@ -2,22 +2,102 @@ DATA_FILEPATH = '/app/slam_data'
 SONAR_FILEPATH = '/app/sonar_data'
 DOCKER_HOST = 'host.docker.internal'
 VEHICLE_IP = '192.168.2.2'
+MAVLINK_HOST = '0.0.0.0'  # UDP endpoint MAVLink telemetry is forwarded to
+MAVLINK_PORT = 14555
+# Sensor buffer history per message: (seconds kept, highest expected rate in Hz)
+SENSOR_HISTORY = {
+    "RAW_IMU": (30.0, 400),
+    "SCALED_IMU2": (30.0, 400),
+    "ATTITUDE": (30.0, 100),
+    "GLOBAL_POSITION_INT": (30.0, 20),
+    "SCALED_PRESSURE": (30.0, 20),
+    "SERVO_OUTPUT_RAW": (30.0, 20),
+    "SYSTEM_TIME": (30.0, 10),
+}
+SENSOR_TIME_RESET = 1.0  # seconds a message timestamp may go back before a buffer starts over
+REST_TIMEOUT = 1.0  # seconds per mavlink2rest request
+REST_CONNECTIONS = 8  # pooled mavlink2rest connections
+REST_KEEPALIVE = 30.0  # seconds an idle pooled connection is kept
+MAVLINK_WS_URL = f"ws://{VEHICLE_IP}:6040/ws/mavlink"  # mavlink2rest WebSocket stream
+MAVLINK_WS_BACKOFF = (0.5, 10.0)  # seconds between reconnection attempts, first and longest
+MAVLINK_WS_HEARTBEAT = 5.0  # seconds between WebSocket pings
+TELEMETRY_SOURCE = None  # fills the sensor buffers: "udp", "websocket", "rest" or None
 PING_BRIDGE = 'UDP 9092'
 PING_DEVICE = '/dev/ttyUSB0'
 VIDEO_STREAM = 'udp://192.168.2.1:5600'
 UDP_PORT = '192.168.2.2:9092'
 VIDEO_PATH = '/dev/video2'
 LIVE_SONAR = False
+REPLAY_FILE = '/app/sonar_data/sonar_better.h5'
+REPLAY_SPEED = 1.0  # multiple of recorded time, 0 replays as fast as possible
+REPLAY_LOOP = True
 
 WATER_SOS = 1481
 
+# Bearings (degrees) of the sector in recordings that do not store their own angles
+RECORDED_ANGLES = [334.8, 335.7, 336.6, 337.5, 338.4, 339.3, 340.2, 341.1, 342,  342.9, 343.8, 344.7,
+                   345.6, 346.5, 347.4, 348.3, 349.2, 350.1, 351,  351.9, 352.8, 353.7, 354.6, 355.5,
+                   356.4, 357.3, 358.2, 359.1,   0,    0.9,   1.8,   2.7,   3.6,   4.5,   5.4,   6.3,
+                   7.2,   8.1,   9,    9.9,  10.8,  11.7,  12.6,  13.5,  14.4,  15.3,  16.2,  17.1,
+                   18,   18.9,  19.8,  20.7,  21.6,  22.5,  23.4,  24.3]
+
 # Sonar settings
 TRANSMIT_DURATION = 25
 SAMPLE_PERIOD = 480
+NUMBER_OF_SAMPLES = 1200
 TRANSMIT_FREQUENCY = 750
+PING_REPLY_TIMEOUT = 0.5  # seconds to wait for a device data message
+SWEEP_RESTARTS = 3  # failed continuous sweeps restarted in a row before scanning gives up
+PING_RETRY_BACKOFF = (0.1, 2.0)  # seconds, first and longest wait before retrying a failed request
+STREAMING_CFAR = True
+SCAN_MODE = "pipelined"  # "request", "pipelined", "auto" (auto-transmit, falls back to pipelined) or "adaptive"
+ADAPTIVE_COARSE_STEP = 4  # gradians between beams over empty sectors
+ADAPTIVE_REFINE_WIDTH = 3  # steps either side of a detection swept at full resolution
+FORWARD_SECTOR = (380, 20)  # gradians, always swept at full resolution
+FORWARD_REVISITS = 1  # extra passes over the forward sector per adaptive sweep
+AUTO_RANGE = False  # pick sample period and count from the furthest recent detection
+AUTO_RANGE_MARGIN = 2.0  # metres listened beyond the furthest detection
+AUTO_RANGE_MIN = 3.0
+AUTO_RANGE_MAX = 50.0
+AUTO_RANGE_HISTORY = 3  # sweeps
+AUTO_RANGE_HYSTERESIS = 0.1  # fraction of the current range
+GEOMETRY_CACHE_SIZE = 3
+BLANKING_DISTANCE = 0.75  # metres of near-field samples dropped from every beam
+TVG_SPREADING = 0.0  # time-varying gain, dB per decade of range (e.g. 40 for two-way spherical spreading)
+TVG_ABSORPTION = 0.0  # time-varying gain, dB per metre of range
+
 
+# Sonar recording
+RECORDING_COMPRESSION = "gzip"  # "gzip", "lzf" or None
+RECORDING_COMPRESSION_LEVEL = 4
+RECORDING_CHUNK_SCANS = 8
+RECORDING_QUEUE_SIZE = 32
+RECORDING_BACKPRESSURE = "drop_oldest"  # "drop_oldest" or "block"
 
 # CFAR settings
 Ntc = 40
 Ngc = 10
 Pfa = 0.01
+CFAR2D_TRAIN_BEAMS = 2  # CA2D/GOCA2D training cells on each side in bearing
+CFAR2D_GUARD_BEAMS = 1
+
+# Sweep processing pipeline, stages from ping.SonarPipeline.STAGES
+PIPELINE_STAGES = ["cfar", "project", "rasterize"]
+DENOISE_METHOD = "median"  # "none", "median", "gaussian" or "opening"
+DENOISE_KSIZE = 3
+DENOISE_SPECKLE = 0  # per-beam opening length in range samples, 0 or 1 disables it
+
+# Adaptive thresholding detectors ("LOCAL" and "OTSU")
+ADAPTIVE_WINDOW = (41, 5)  # range x beam samples of the LOCAL statistics window
+ADAPTIVE_K = 2.0  # LOCAL threshold is mean + ADAPTIVE_K * std
+ADAPTIVE_BAND = 100  # range samples per OTSU band
+
+# CFAR threshold factor cache
+CFAR_CACHE_SIZE = 256
+CFAR_CACHE_FILEPATH = '/app/slam_data/cfar_thresholds.json'
+CFAR_WARMUP = True
+CFAR_WARMUP_GRID = {
+    "alg": ["CA", "SOCA", "GOCA", "OS"],
+    "Ntc": [20, 30, 40, 50, 60],
+    "Pfa": [0.1, 0.05, 0.01, 0.005, 0.001],
+}
@@ -14,6 +14,21 @@ class MavlinkMessage(str, Enum):
     SYSTEM_TIME = "SYSTEM_TIME"
 
 
+# Fields kept in the sensor buffers of each message, the first one is its timestamp
+MAVLINK_FIELDS = {
+    MavlinkMessage.ATTITUDE: ("time_boot_ms", "roll", "pitch", "yaw", "rollspeed", "pitchspeed", "yawspeed"),
+    MavlinkMessage.GLOBAL_POSITION_INT: ("time_boot_ms", "lat", "lon", "alt", "relative_alt", "vx", "vy", "vz",
+                                         "hdg"),
+    MavlinkMessage.SCALED_IMU: ("time_boot_ms", "xacc", "yacc", "zacc", "xgyro", "ygyro", "zgyro", "xmag", "ymag",
+                                "zmag"),
+    MavlinkMessage.RAW_IMU: ("time_usec", "xacc", "yacc", "zacc", "xgyro", "ygyro", "zgyro", "xmag", "ymag", "zmag"),
+    MavlinkMessage.SCALED_PRESSURE: ("time_boot_ms", "press_abs", "press_diff", "temperature"),
+    MavlinkMessage.SERVO_OUTPUT_RAW: ("time_usec", "servo1_raw", "servo2_raw", "servo3_raw", "servo4_raw",
+                                      "servo5_raw", "servo6_raw", "servo7_raw", "servo8_raw"),
+    MavlinkMessage.SYSTEM_TIME: ("time_boot_ms", "time_unix_usec"),
+}
+
+
 class GPSData(BaseModel):
     timestamp: int
     altitude: float